@@ -0,0 +1,160 @@
+#
+# Optimal Control of a Vehicle
+# Code Generation of the Dynamics and of its Derivatives
+# Rapallini Antonio & Bertamè Sebastiano
+# Bologna, 04/01/2024
+#
+
+import os
+import hashlib
+import itertools
+import importlib.util
+from sympy import symbols, numbered_symbols, sin, cos, Matrix, Float, cse, diff
+from sympy.printing.numpy import NumPyPrinter
+
+# Generated kernels are stored here, one file per model and parameter set
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__gencache__')
+
+
+#######################################
+# Symbolic models (continuous time)
+#######################################
+
+def vehicle_model(params):
+
+    # Bicycle model, xx = [x, y, psi, V, beta, psidot] and uu = [delta, F]
+    mm, Iz, aa, bb, mi, gg = [Float(params[name]) for name in ('mm', 'Iz', 'aa', 'bb', 'mi', 'gg')]
+
+    xx = symbols('x0:6')
+    uu = symbols('u0:2')
+    x0, x1, x2, x3, x4, x5 = xx
+    u0, u1 = uu
+
+    # Slip angles, vertical and lateral forces at front and rear
+    Beta = [u0 - (x3*sin(x4) + aa*x5)/(x3*cos(x4)), - (x3*sin(x4) - bb*x5)/(x3*cos(x4))]
+    Fz = [mm*gg*bb/(aa+bb), mm*gg*aa/(aa+bb)]
+    Fy = [mi*Fz[0]*Beta[0], mi*Fz[1]*Beta[1]]
+
+    ff = [x3*cos(x4)*cos(x2) - x3*sin(x4)*sin(x2),
+          x3*cos(x4)*sin(x2) + x3*sin(x4)*cos(x2),
+          x5,
+          (Fy[1]*sin(x4) + u1*cos(x4 - u0) + Fy[0]*sin(x4 - u0))/mm,
+          (Fy[1]*cos(x4) + Fy[0]*cos(x4 - u0) - u1*sin(x4 - u0))/(mm*x3) - x5,
+          ((u1*sin(u0) + Fy[0]*cos(u0))*aa - Fy[1]*bb)/Iz]
+
+    return xx, uu, ff
+
+
+def pendulum_model(params):
+
+    # Damped pendulum, xx = [theta, theta dot] and uu = [torque]
+    mm, ll, kk, gg = [Float(params[name]) for name in ('mm', 'll', 'kk', 'gg')]
+
+    xx = symbols('x0:2')
+    uu = symbols('u0:1')
+
+    ff = [xx[1],
+          - gg/ll*sin(xx[0]) - kk/(mm*ll)*xx[1] + 1/(mm*(ll**2))*uu[0]]
+
+    return xx, uu, ff
+
+
+MODELS = {'vehicle': vehicle_model, 'pendulum': pendulum_model}
+
+
+#######################################
+# Source generation
+#######################################
+
+def generate(model, params):
+
+    # Build the source of a module exposing
+    #   f(xx, uu)     -> ff (ns, ...), continuous-time vector field
+    #   f_jac(xx, uu) -> ff_x (ns, ns, ...), ff_u (ns, ni, ...), with ff_x[i,j] = d ff_i / d x_j
+    #   f_hess(xx, uu) -> ff_xx (ns, ns, ns, ...), ff_uu (ns, ni, ni, ...), ff_xu (ns, ns, ni, ...),
+    #                     with ff_xu[i,j,k] = d^2 ff_i / d x_j d u_k
+    # Every function works on a single sample, (ns,) and (ni,), or on samples stored by columns
+
+    xx, uu, ff = MODELS[model](params)
+    ns, ni = len(xx), len(uu)
+
+    ff = Matrix(ff)
+    ff_x = ff.jacobian(Matrix(xx))
+    ff_u = ff.jacobian(Matrix(uu))
+
+    ff_xx = [diff(ff_x[ii, jj], xk) for ii in range(ns) for jj in range(ns) for xk in xx]
+    ff_uu = [diff(ff_u[ii, jj], uk) for ii in range(ns) for jj in range(ni) for uk in uu]
+    ff_xu = [diff(ff_x[ii, jj], uk) for ii in range(ns) for jj in range(ns) for uk in uu]
+
+    printer = NumPyPrinter({'fully_qualified_modules': True})
+
+    def function(name, outputs):
+
+        # outputs is a list of (array name, shape, flat list of expressions)
+        exprs = [ee for out in outputs for ee in out[2]]
+        subexprs, reduced = cse(exprs, symbols=numbered_symbols('c'))
+
+        lines = ['def {}(xx, uu):'.format(name), '']
+        lines += ['    {} = xx[{}]'.format(xi, ii) for ii, xi in enumerate(xx)]
+        lines += ['    {} = uu[{}]'.format(ui, ii) for ii, ui in enumerate(uu)]
+        lines += ['    shape = numpy.shape(x0)', '']
+        lines += ['    {} = {}'.format(sym, printer.doprint(ee)) for sym, ee in subexprs]
+        lines += ['']
+
+        kk = 0
+        for out_name, shape, out_exprs in outputs:
+            lines += ['    {} = numpy.zeros({} + shape)'.format(out_name, shape)]
+            for index in itertools.product(*[range(nn) for nn in shape]):
+                if reduced[kk] != 0:
+                    index = ','.join(str(ii) for ii in index)
+                    lines += ['    {}[{}] = {}'.format(out_name, index, printer.doprint(reduced[kk]))]
+                kk += 1
+            lines += ['']
+
+        lines += ['    return {}'.format(', '.join(out[0] for out in outputs)), '', '']
+
+        return lines
+
+    source = ['#', '# Generated by Codegen.py -- do not edit', '# model: {}, params: {}'.format(model, params), '#', '',
+              'import numpy', '', 'ns = {}'.format(ns), 'ni = {}'.format(ni), '', '']
+    source += function('f', [('ff', (ns,), list(ff))])
+    source += function('f_jac', [('ff_x', (ns, ns), list(ff_x)), ('ff_u', (ns, ni), list(ff_u))])
+    source += function('f_hess', [('ff_xx', (ns, ns, ns), ff_xx), ('ff_uu', (ns, ni, ni), ff_uu), ('ff_xu', (ns, ns, ni), ff_xu)])
+
+    return '\n'.join(source)
+
+
+#######################################
+# Disk cache
+#######################################
+
+def load(model, params):
+
+    # Return the generated module for the given model and parameters. The source is rebuilt only
+    # if the parameters (or this generator) changed since the last time it was written to disk
+
+    with open(os.path.abspath(__file__), 'rb') as generator:
+        key = hashlib.sha1(generator.read() + repr((model, sorted(params.items()))).encode()).hexdigest()[:16]
+
+    name = '{}_{}'.format(model, key)
+    path = os.path.join(CACHE_DIR, name + '.py')
+
+    if not os.path.exists(path):
+        source = generate(model, params)
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            temp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temp_path, 'w') as file:
+                file.write(source)
+            os.replace(temp_path, path)     # atomic, safe if several processes generate at once
+        except OSError:
+            # read-only installation: keep the kernel in memory only
+            module = type(os)(name)
+            exec(compile(source, name, 'exec'), module.__dict__)
+            return module
+
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
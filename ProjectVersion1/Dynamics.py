@@ -5,177 +5,345 @@
 # Bologna, 04/01/2024
 #
 
-from sympy import symbols, diff
 import numpy as np
+import Codegen
+
 vehicle_dyn = True          # change to switch between bicycle or pendulum dynamics
+integrator = 'euler'        # discretization: 'euler' (Forward Euler), 'rk4' (Runge-Kutta 4) or 'midpoint' (implicit midpoint)
 
-dt = 1e-2           # discretization stepsize - Forward Euler
+dt = 1e-2           # discretization stepsize
 tf = 5              # Final time in seconds
-TT = int(tf/dt)     # Number of discrete-time samples
-TT_mid = TT/2
 
-if vehicle_dyn:
-    # Constants for the dynamics
-    ns = 6  # number of states
-    ni = 2  # number of inputs
-
-    # Vehicle parameters
-    mm = 1480   # Kg
-    Iz = 1950   # Kg*mm^2
-    aa = 1.421  # mm           
-    bb = 1.029  # mm
-    mi = 1      # nodim
-    gg = 9.81   # mm/s^2
+# Default parameters of the two models
+VEHICLE_PARAMS = {
+    'mm': 1480,     # Kg
+    'Iz': 1950,     # Kg*mm^2
+    'aa': 1.421,    # mm
+    'bb': 1.029,    # mm
+    'mi': 1,        # nodim
+    'gg': 9.81,     # mm/s^2
+}
 
-else:
-    # Constants for the dynamics
-    ns = 2  # number of states
-    ni = 1  # number of inputs
+PENDULUM_PARAMS = {
+    'mm': 0.4,
+    'll': 0.2,
+    'kk': 1,
+    'gg': 9.81,
+}
+
+
+#######################################
+# Model
+#######################################
+
+class Model:
+
+    # Vehicle (or pendulum) model carrying its own parameters and discretization. Every model has
+    # its own generated kernel (see Codegen.py), so several models, with different parameters or
+    # horizons, can be used at the same time in one process or in a thread/process pool
+
+    midpoint_maxiters = 20      # Newton's iterations of the implicit midpoint rule
+    midpoint_tol = 1e-12        # tolerance on the residual of the implicit midpoint rule
+    hessian_step = 1e-5         # relative step of the central differences in hessians() (RK4 and midpoint)
+
+    def __init__(self, vehicle_dyn=True, integrator='euler', dt=1e-2, tf=5, **params):
+
+        self.vehicle_dyn = vehicle_dyn
+        self.integrator = integrator
+
+        self.dt = dt                    # discretization stepsize
+        self.tf = tf                    # Final time in seconds
+        self.TT = int(round(tf/dt))     # Number of discrete-time samples
+        self.TT_mid = self.TT/2
+
+        if vehicle_dyn:
+            self.ns = 6  # number of states
+            self.ni = 2  # number of inputs
+            defaults = VEHICLE_PARAMS
+        else:
+            self.ns = 2  # number of states
+            self.ni = 1  # number of inputs
+            defaults = PENDULUM_PARAMS
+
+        for name in params:
+            if name not in defaults:
+                raise ValueError("Unknown parameter '{}' for the {} model".format(name, self.kind))
+
+        self.params = dict(defaults, **params)
+        self.__dict__.update(self.params)   # mm, Iz, ... as attributes
+
+        if not vehicle_dyn:
+            self.KKeq = self.mm*self.gg*self.ll  # K for equilibrium
+
+        self.load_kernel()
+
+    @property
+    def kind(self):
+        return 'vehicle' if self.vehicle_dyn else 'pendulum'
+
+    def load_kernel(self):
+
+        # Continuous-time vector field and derivatives generated with SymPy,
+        # rebuilt only when the parameters change
+        self.kernel = Codegen.load(self.kind, self.params)
+
+    def __getstate__(self):
+
+        # The generated kernel is a module and cannot be pickled: it is loaded again on the other side
+        state = self.__dict__.copy()
+        del state['kernel']
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.load_kernel()
+
+    def __repr__(self):
+
+        return 'Model({}, integrator={!r}, dt={}, tf={}, {})'.format(
+            self.kind, self.integrator, self.dt, self.tf, ', '.join('{}={}'.format(*item) for item in self.params.items()))
+
+    #######################################
+    # Car Dynamics
+    #######################################
+
+    def dynamics(self, xx, uu, jacobian=True):
+
+        # With jacobian=False only the next state is evaluated and fx, fu are returned as None,
+        # so that dynamics(xx, uu, jacobian=False)[0] is a cheap replacement for dynamics(xx, uu)[0]
+        if not jacobian:
+            return self.next_state(xx, uu), None, None
+
+        xxp, AA, BB = self.discretize(xx, uu)
+
+        # Gradient wrt xx and uu (df/dx and df/du)
+        fx = AA.T
+        fu = BB.T
+
+        return xxp, fx, fu
+
+    def next_state(self, xx, uu):
+
+        # Next state without building the Jacobians. Works both on a single sample, (ns,) and (ni,),
+        # and on a batch of samples stored by columns, (ns, N) and (ni, N)
+
+        return self.discretize(xx, uu, jacobian=False)[0]
+
+    def dynamics_batch(self, xx, uu):
+
+        # Vectorized version of dynamics(): xx is (ns, N) and uu is (ni, N), every column is
+        # an independent sample. Returns the next states (ns, N) and the Jacobians stacked
+        # along the first axis, fx (N, ns, ns) and fu (N, ni, ns), with the same layout as dynamics()
+
+        xxp, AA, BB = self.discretize(xx, uu)
+
+        fx = AA.transpose(2, 1, 0)
+        fu = BB.transpose(2, 1, 0)
+
+        return xxp, fx, fu
+
+    def linearize(self, xx, uu):
+
+        # Linearization along a whole trajectory, xx is (ns, TT) and uu is (ni, TT).
+        # Returns the stacks AA (ns, ns, TT) and BB (ns, ni, TT) with AA[:,:,tt] = fx.T and
+        # BB[:,:,tt] = fu.T, i.e. already in the layout used by the Newton's method and by the LQR
+
+        return self.discretize(xx, uu)[1:]
+
+    #######################################
+    # Discretization
+    #######################################
+
+    def discretize(self, xx, uu, jacobian=True):
+
+        # Discrete-time map xxp = F(xx, uu) of the chosen integrator and its exact Jacobians
+        # AA = dF/dxx (ns, ns, ...) and BB = dF/duu (ns, ni, ...), obtained by differentiating the
+        # integration scheme itself. Every array keeps the trailing sample dimensions of xx and uu
+
+        xx = np.asarray(xx, dtype=float)
+        uu = np.asarray(uu, dtype=float)
 
-    # Pendulum parameters
-    mm = 0.4
-    ll = 0.2
-    kk = 1
-    gg = 9.81
-    KKeq = mm*gg*ll # K for equilibrium
+        kernel = self.kernel
+        dt = self.dt
+        II = identity(self.ns, xx)
 
+        if self.integrator == 'euler':
+
+            xxp = xx + dt * kernel.f(xx, uu)
+
+            if not jacobian:
+                return xxp, None, None
+
+            ff_x, ff_u = kernel.f_jac(xx, uu)
+
+            return xxp, II + dt * ff_x, dt * ff_u
+
+        if self.integrator == 'rk4':
+
+            k1 = kernel.f(xx, uu)
+            k2 = kernel.f(xx + dt/2 * k1, uu)
+            k3 = kernel.f(xx + dt/2 * k2, uu)
+            k4 = kernel.f(xx + dt * k3, uu)
+
+            xxp = xx + dt/6 * (k1 + 2*k2 + 2*k3 + k4)
+
+            if not jacobian:
+                return xxp, None, None
+
+            # Chain rule through the stages, dki/dxx and dki/duu
+            ff_x, ff_u = kernel.f_jac(xx, uu)
+            k1_x, k1_u = ff_x, ff_u
+
+            ff_x, ff_u = kernel.f_jac(xx + dt/2 * k1, uu)
+            k2_x = ff_x + dt/2 * matmul(ff_x, k1_x)
+            k2_u = ff_u + dt/2 * matmul(ff_x, k1_u)
+
+            ff_x, ff_u = kernel.f_jac(xx + dt/2 * k2, uu)
+            k3_x = ff_x + dt/2 * matmul(ff_x, k2_x)
+            k3_u = ff_u + dt/2 * matmul(ff_x, k2_u)
+
+            ff_x, ff_u = kernel.f_jac(xx + dt * k3, uu)
+            k4_x = ff_x + dt * matmul(ff_x, k3_x)
+            k4_u = ff_u + dt * matmul(ff_x, k3_u)
+
+            AA = II + dt/6 * (k1_x + 2*k2_x + 2*k3_x + k4_x)
+            BB = dt/6 * (k1_u + 2*k2_u + 2*k3_u + k4_u)
+
+            return xxp, AA, BB
+
+        if self.integrator == 'midpoint':
+
+            # Solve xxp = xx + dt * f((xx + xxp)/2, uu) with Newton's method, Forward Euler as first guess
+            xxp = xx + dt * kernel.f(xx, uu)
+
+            # The residual is tested before the update, so that the returned xxp is the one that satisfies it
+            for ii in range(self.midpoint_maxiters):
+                xx_mid = (xx + xxp)/2
+                res = xxp - xx - dt * kernel.f(xx_mid, uu)
+                if np.max(np.abs(res)) < self.midpoint_tol:
+                    break
+                ff_x, ff_u = kernel.f_jac(xx_mid, uu)
+                MM = II - dt/2 * ff_x
+                xxp = xxp - solve(MM, res)
+            else:
+                print("Implicit midpoint: residual {:.3e} after {} iterations, the step and its Jacobians are not "
+                      "consistent (increase midpoint_maxiters or reduce dt)".format(np.max(np.abs(res)), self.midpoint_maxiters))
+
+            if not jacobian:
+                return xxp, None, None
+
+            # Implicit function theorem at the solution: (I - dt/2 fx) dxxp = (I + dt/2 fx) dxx + dt fu duu
+            xx_mid = (xx + xxp)/2
+            ff_x, ff_u = kernel.f_jac(xx_mid, uu)
+            MM = II - dt/2 * ff_x
+
+            AA = solve(MM, II + dt/2 * ff_x)
+            BB = solve(MM, dt * ff_u)
+
+            return xxp, AA, BB
+
+        raise ValueError("Unknown integrator '{}', use 'euler', 'rk4' or 'midpoint'".format(self.integrator))
+
+    #######################################
+    # Second-order terms
+    #######################################
+
+    def hessians(self, xx, uu):
+
+        # Second derivatives of the discrete-time dynamics along a trajectory, xx is (ns, TT) and
+        # uu is (ni, TT) (or a single sample):
+        #   f_xx (ns, ns, ns, TT), f_xx[i,j,k,tt] = d^2 f_i / d x_j d x_k
+        #   f_uu (ns, ni, ni, TT), f_uu[i,j,k,tt] = d^2 f_i / d u_j d u_k
+        #   f_xu (ns, ns, ni, TT), f_xu[i,j,k,tt] = d^2 f_i / d x_j d u_k
+        # With Forward Euler they are dt times the generated continuous ones. For the other integrators
+        # they are central differences of the exact discrete Jacobians
+
+        xx = np.asarray(xx, dtype=float)
+        uu = np.asarray(uu, dtype=float)
+        ns, ni = self.ns, self.ni
+
+        if self.integrator == 'euler':
+            ff_xx, ff_uu, ff_xu = self.kernel.f_hess(xx, uu)
+            return self.dt * ff_xx, self.dt * ff_uu, self.dt * ff_xu
+
+        f_xx = np.zeros((ns, ns, ns) + xx.shape[1:])
+        f_uu = np.zeros((ns, ni, ni) + xx.shape[1:])
+        f_xu = np.zeros((ns, ns, ni) + xx.shape[1:])
+
+        for kk in range(ns):
+            hh = self.hessian_step * (1 + np.abs(xx[kk]))
+            dx = np.zeros_like(xx)
+            dx[kk] = hh
+            AAp = self.discretize(xx + dx, uu)[1]
+            AAm = self.discretize(xx - dx, uu)[1]
+            f_xx[:,:,kk] = (AAp - AAm)/(2*hh)
+
+        for kk in range(ni):
+            hh = self.hessian_step * (1 + np.abs(uu[kk]))
+            du = np.zeros_like(uu)
+            du[kk] = hh
+            AAp, BBp = self.discretize(xx, uu + du)[1:]
+            AAm, BBm = self.discretize(xx, uu - du)[1:]
+            f_uu[:,:,kk] = (BBp - BBm)/(2*hh)
+            f_xu[:,:,kk] = (AAp - AAm)/(2*hh)
+
+        return f_xx, f_uu, f_xu
 
 
 #######################################
-# Car Dynamics
+# Helpers
 #######################################
 
-def dynamics(xx, uu):
-
-    ############################################## BICYCLE DYNAMICS ########################################################
-
-    if vehicle_dyn:
-    
-        # Add aa dimension for improving the compatibility of the code
-        xx = xx[:, None]
-        uu = uu[:, None]     
-        
-        # Preallocate the next state vector
-        xxp = np.zeros((ns,1))
-        
-        # Pre-compute repeated terms for efficiency
-        cos_xx4 = np.cos(xx[4,0])
-        sin_xx4 = np.sin(xx[4,0])
-        cos_xx2 = np.cos(xx[2,0])
-        sin_xx2 = np.sin(xx[2,0])
-        cos_xx4_minus_uu0 = np.cos(xx[4,0] - uu[0,0])
-        sin_xx4_minus_uu0 = np.sin(xx[4,0] - uu[0,0])
-
-        # Compute slip angles for front and rear (Beta_f, Beta_r)
-        Beta = ([
-            uu[0,0] - (xx[3,0]*sin_xx4 + aa*xx[5,0]) / (xx[3,0]*cos_xx4), 
-            - (xx[3,0]*sin_xx4 - bb*xx[5,0]) / (xx[3,0]*cos_xx4)
-        ])
-
-        dBetax3 = ([
-            aa*xx[5,0]/((xx[3,0]**2)*cos_xx4),
-            -(bb*xx[5,0])/((xx[3,0]**2)*cos_xx4)
-        ])
-        
-        dBetax4 = ([
-            -(xx[3,0] + sin_xx4*aa*xx[5,0])/(xx[3,0]*(cos_xx4**2)),
-            -(xx[3,0] - sin_xx4*bb*xx[5,0])/(xx[3,0]*(cos_xx4**2))
-        ])
-
-        dBetax5 = ([
-            -aa/(xx[3,0]*cos_xx4),
-            bb/(xx[3,0]*cos_xx4)
-        ])
-
-        dBetau0 = ([
-            1,
-            0
-        ])
-        
-        # Compute vertical forces at front and rear (F_zf, F_zr)
-        Fz = ([mm*gg*bb/(aa+bb), mm*gg*aa/(aa+bb)])
-
-        # Compute lateral forces at front and rear (F_yf, F_yr)
-        Fy = ([mi*Fz[0]*Beta[0], mi*Fz[1]*Beta[1]])
-
-        dFyx3 = ([mi*Fz[0]*dBetax3[0], mi*Fz[1]*dBetax3[1]])
-        dFyx4 = ([mi*Fz[0]*dBetax4[0], mi*Fz[1]*dBetax4[1]])
-        dFyx5 = ([mi*Fz[0]*dBetax5[0], mi*Fz[1]*dBetax5[1]])
-        dFyu0 = ([mi*Fz[0]*dBetau0[0], mi*Fz[1]*dBetau0[1]])
-
-        
-        # Discrete-time nonlinear dynamics calculations for next state
-        xxp[0] = xx[0,0] + dt * (xx[3,0] * cos_xx4 * cos_xx2 - xx[3,0] * sin_xx4 * sin_xx2)                                 
-        xxp[1] = xx[1,0] + dt * (xx[3,0] * cos_xx4 * sin_xx2 + xx[3,0] * sin_xx4 * cos_xx2)                                 
-        xxp[2] = xx[2,0] + dt * xx[5,0]                                                                                                           
-        xxp[3] = xx[3,0] + dt * ((Fy[1] * sin_xx4 + uu[1,0] * cos_xx4_minus_uu0 + Fy[0] * sin_xx4_minus_uu0)/mm)                     
-        xxp[4] = xx[4,0] + dt * ((Fy[1] * cos_xx4 + Fy[0] * cos_xx4_minus_uu0 - uu[1,0] * sin_xx4_minus_uu0)/(mm * xx[3,0]) - xx[5,0])   
-        xxp[5] = xx[5,0] + dt * (((uu[1,0] * np.sin(uu[0,0]) + Fy[0] * np.cos(uu[0,0])) * aa - Fy[1] * bb)/Iz) 
-
-        # Discrete-time nonlinear dynamics calculations for next state
-       
-        # Gradient computation (for future use in optimization)
-        # Gradient wrt xx and uu (df/dx and df/du)
-        fx = np.zeros((ns, ns))
-        fu = np.zeros((ni, ns))
-    
-        # Derivative of dynamics w.r.t. state (fx)
-        fx[0,:] = [1, 0, 0, 0, 0, 0]
-        fx[1,:] = [0, 1, 0, 0, 0, 0]
-        fx[2,:] = [dt*(-xx[3,0] * cos_xx4 * sin_xx2 - xx[3,0] * sin_xx4 * cos_xx2), dt*(xx[3,0] * cos_xx4 * cos_xx2 - xx[3,0] * sin_xx4 * sin_xx2), 1, 0, 0, 0]
-        fx[3,:] = [dt*(cos_xx4 * cos_xx2 - sin_xx4 * sin_xx2), dt*(cos_xx4 * sin_xx2 + sin_xx4 * cos_xx2), 0, 1 + dt*((dFyx3[1]*sin_xx4 + dFyx3[0]*sin_xx4_minus_uu0)/mm), 
-                   dt*(((dFyx3[1]*cos_xx4 + dFyx3[0]*cos_xx4_minus_uu0)*(mm * xx[3,0]) - mm*(Fy[1]*cos_xx4 + Fy[0]*cos_xx4_minus_uu0 - uu[1,0]*sin_xx4_minus_uu0))/((mm * xx[3,0])**2)), 
-                   dt*(((dFyx3[0]*np.cos(uu[0,0]))*aa - dFyx3[1]*bb)/Iz)]
-        fx[4,:] = [dt*(-xx[3,0]*sin_xx4*cos_xx2 - xx[3,0]*cos_xx4*sin_xx2), dt*(-xx[3,0]*sin_xx4*sin_xx2 + xx[3,0]*cos_xx4*cos_xx2), 0, 
-                   dt*((dFyx4[1]*sin_xx4 + Fy[1]*cos_xx4 - uu[1,0]*sin_xx4_minus_uu0 + dFyx4[0]*sin_xx4_minus_uu0 + Fy[0]*cos_xx4_minus_uu0)/mm), 
-                   1 + dt*((dFyx4[1]*cos_xx4 - Fy[1]*sin_xx4 + dFyx4[0]*cos_xx4_minus_uu0 - Fy[0]*sin_xx4_minus_uu0 - uu[1,0]*cos_xx4_minus_uu0)/(mm*xx[3,0])), 
-                   dt*(((dFyx4[0]*np.cos(uu[0,0]))*aa - dFyx4[1]*bb)/Iz)]
-        fx[5,:] = [0, 0, dt, dt*((dFyx5[1]*sin_xx4 + dFyx5[0]*sin_xx4_minus_uu0)/mm), dt*((dFyx5[1]*cos_xx4 + dFyx5[0]*cos_xx4_minus_uu0)/(mm * xx[3,0]) - 1), 
-                   1 + dt*(((dFyx5[0]*np.cos(uu[0,0]))*aa - dFyx5[1]*bb)/Iz)]
-        
-        # Derivative of dynamics w.r.t. inputs (fu)
-        fu[0,:] = [0, 0, 0, dt*((dFyu0[1]*sin_xx4 + uu[1,0]*sin_xx4_minus_uu0 + dFyu0[0]*sin_xx4_minus_uu0 - Fy[0]*cos_xx4_minus_uu0)/mm), 
-                   dt*((dFyu0[1]*cos_xx4 + dFyu0[0]*cos_xx4_minus_uu0 + Fy[0]*sin_xx4_minus_uu0 + uu[1,0]*cos_xx4_minus_uu0)/(mm * xx[3,0])),  
-                   dt*(((uu[1,0]*np.cos(uu[0,0]) + dFyu0[0]*np.cos(uu[0,0]) - Fy[0]*np.sin(uu[0,0]))*aa - dFyu0[1]*bb)/Iz)]
-        fu[1,:] = [0, 0, 0, dt*cos_xx4_minus_uu0/mm, dt*(- sin_xx4_minus_uu0)/(mm * xx[3,0]), dt*np.sin(uu[0,0])*aa/Iz]
-    
-        # Removing singleton dimensions for the next state
-        xxp = xxp.squeeze()
-
-        ############################################## PENDULUM DYNAMICS ########################################################
-
-    else:
-
-        # Add aa dimension for improving the compatibility of the code
-        xx = xx[:, None]
-        uu = uu[:, None]     
-        
-        # Preallocate the next state vector
-        xxp = np.zeros((ns, 1))
-
-        # Discrete-time nonlinear dynamics calculations for next state
-        xxp[0] = xx[0,0] + dt * xx[1,0]
-        xxp[1] = xx[1,0] + dt * (- gg / ll * np.sin(xx[0,0]) - kk / (mm * ll) * xx[1,0] + 1 / (mm * (ll ** 2)) * uu[0,0])                                       
-
-        # Gradient computation (for future use in optimization)
-        # Gradient wrt xx and uu (df/dx and df/du)
-        fx = np.zeros((ns, ns))
-        fu = np.zeros((ni, ns))
+def identity(ns, xx):
+
+    # Identity (ns, ns) repeated along the trailing sample dimensions of xx
+    return np.eye(ns).reshape((ns, ns) + (1,)*(xx.ndim - 1))
+
+
+def matmul(AA, BB):
 
-        # Derivative of dynamics w.r.t. state (fx)
-        fx[0,0] = 1
-        fx[1,0] = dt
+    # Matrix product over the first two axes, sample by sample
+    return np.einsum('ij...,jk...->ik...', AA, BB)
 
-        # Derivative of dynamics w.r.t. input (fu)
-        fu[0,0] = 0
 
-        #df2
-        fx[0,1] = dt*-gg / ll * np.cos(xx[0,0])
-        fx[1,1] = 1 + dt*(- kk / (mm * ll))
+def solve(AA, BB):
 
-        fu[0,1] = dt / (mm * (ll ** 2))
+    # Solve AA @ XX = BB over the first two axes, sample by sample (BB can also be a vector per sample)
+    vector = BB.ndim == AA.ndim - 1
+    if vector:
+        BB = BB[:, None]
+
+    AA = np.moveaxis(AA, (0, 1), (-2, -1))
+    BB = np.moveaxis(BB, (0, 1), (-2, -1))
+    XX = np.moveaxis(np.linalg.solve(AA, BB), (-2, -1), (0, 1))
+
+    return XX[:, 0] if vector else XX
+
+
+#######################################
+# Default model
+#######################################
+
+# The module-level names below describe the default model and are kept for the scripts that use
+# them directly (dyn.ns, dyn.TT, dyn.dynamics, ...). Create other Model objects for parameter sweeps
+
+model = Model(vehicle_dyn=vehicle_dyn, integrator=integrator, dt=dt, tf=tf)
+
+ns = model.ns           # number of states
+ni = model.ni           # number of inputs
+TT = model.TT           # Number of discrete-time samples
+TT_mid = model.TT_mid
+
+if vehicle_dyn:
+    mm, Iz, aa, bb, mi, gg = [model.params[name] for name in ('mm', 'Iz', 'aa', 'bb', 'mi', 'gg')]
+else:
+    mm, ll, kk, gg = [model.params[name] for name in ('mm', 'll', 'kk', 'gg')]
+    KKeq = model.KKeq   # K for equilibrium
 
-        # Removing singleton dimensions for the next state
-        xxp = xxp.squeeze()
-       
-    return xxp, fx, fu
+dynamics = model.dynamics
+next_state = model.next_state
+dynamics_batch = model.dynamics_batch
+linearize = model.linearize
+discretize = model.discretize
+hessians = model.hessians
@@ -0,0 +1,303 @@
+#
+# Optimal Control of a Vehicle
+# Cornering Equilibria of the Vehicle
+# Rapallini Antonio & Bertamè Sebastiano
+# Bologna, 04/01/2024
+#
+
+import os
+import hashlib
+import numpy as np
+from scipy.optimize import fsolve
+from scipy.interpolate import RegularGridInterpolator
+import Dynamics as dyn
+import Codegen
+
+
+#######################################
+# Cornering equilibria
+#######################################
+
+# We evaluate the cornering equilibria, so setting Betadot = 0, Vdot = 0 and Psidotdot = 0
+# Then imposing V(x3) and Beta(x4) we evaluate the other states and inputs
+
+def equations(vars, x3, x4, model):
+
+    # Vdot, Betadot and Psidotdot at V = x3, Beta = x4 with vars = [x5, u0, u1] (psi dot, steering angle, force)
+    mm, Iz, aa, bb, mi, gg = model.mm, model.Iz, model.aa, model.bb, model.mi, model.gg
+
+    Beta = [vars[1] - (x3*np.sin(x4) + aa*vars[0])/(x3*np.cos(x4)), - (x3*np.sin(x4) - bb*vars[0])/(x3*np.cos(x4))]               # Beta = [Beta_f, Beta_r]
+    Fz = [mm*gg*bb/(aa+bb), mm*gg*aa/(aa+bb)]                                                                                     # Fz = [F_zf, F_zr]
+    Fy = [mi*Fz[0]*Beta[0], mi*Fz[1]*Beta[1]]                                                                                     # Fy = [F_yf, F_yr]
+
+    return [((Fy[1] * np.sin(x4) + vars[2] * np.cos(x4 - vars[1]) + Fy[0] * np.sin(x4 - vars[1]))/mm),
+            (Fy[1] * np.cos(x4) + Fy[0] * np.cos(x4 - vars[1]) - vars[2] * np.sin(x4 - vars[1]))/(mm * x3) - vars[0],
+            ((vars[2] * np.sin(vars[1]) + Fy[0] * np.cos(vars[1])) * aa - Fy[1] * bb)/Iz]
+
+
+def trim(V, beta, model=None, guess=(0.1, 0.1, 5)):
+
+    # Cornering equilibrium with speed V and sideslip angle beta of the vehicle model (dyn.model if None).
+    # Returns [psi dot, steering angle, force], i.e. the entries 5: of the equilibrium [xx; uu].
+    # Solved with trim_batch(), fsolve on equations() is used if it does not converge
+    if model is None:
+        model = dyn.model
+
+    vars, converged = trim_batch(V, beta, model, guess)
+
+    if converged[0]:
+        return vars[:,0]
+
+    return fsolve(equations, list(guess), args=(V, beta, model))
+
+
+#######################################
+# Batched solver
+#######################################
+
+trim_maxiters = 50      # Newton's iterations of trim_batch()
+trim_tol = 1e-10        # tolerance on the residuals Vdot, Betadot, Psidotdot
+trim_halvings = 20      # largest number of halvings of the Newton's step
+
+
+def residuals(vars, V, beta, kernel, jacobian=True):
+
+    # Rows 3:6 (Vdot, Betadot, Psidotdot) of the generated vector field and their Jacobian with
+    # respect to vars = [x5, u0, u1], for samples stored by columns. The Jacobian is (N, 3, 3)
+    xx = np.zeros((6,) + np.shape(V))
+    xx[3] = V
+    xx[4] = beta
+    xx[5] = vars[0]
+    uu = vars[1:]
+
+    res = kernel.f(xx, uu)[3:]
+
+    if not jacobian:
+        return res, None
+
+    ff_x, ff_u = kernel.f_jac(xx, uu)
+    jac = np.concatenate((ff_x[3:,5:], ff_u[3:]), axis=1)
+
+    return res, np.moveaxis(jac, -1, 0)
+
+
+def trim_batch(V, beta, model=None, guess=(0.1, 0.1, 5)):
+
+    # Cornering equilibria for a whole vector of targets at once: V and beta are arrays (N,) (or
+    # scalars, broadcast to each other) and guess is (3,) or (3, N). Newton's method on the residuals
+    # of the generated kernel with their analytic Jacobian, the step of every target is halved until
+    # its residual decreases (a target whose residual does not decrease in trim_halvings halvings
+    # keeps its iterate and is not iterated any more, it is reported as not converged). Returns vars (3, N), [psi dot, steering angle, force] for every target,
+    # and a boolean array (N,) telling which targets converged
+
+    if model is None:
+        model = dyn.model
+
+    V, beta = np.broadcast_arrays(np.atleast_1d(np.asarray(V, dtype=float)), np.asarray(beta, dtype=float))
+    NN = V.shape[0]
+
+    vars = np.array(guess, dtype=float).reshape(3, -1) * np.ones((1, NN))
+    res = residuals(vars, V, beta, model.kernel, jacobian=False)[0]
+    norm = np.max(np.abs(res), axis=0)
+    stuck = np.zeros(NN, dtype=bool)
+
+    for kk in range(trim_maxiters):
+
+        active = (norm > trim_tol) & ~stuck
+        if not np.any(active):
+            break
+
+        res, jac = residuals(vars[:,active], V[active], beta[active], model.kernel)
+        step = -np.linalg.solve(jac, res.T[:,:,None])[:,:,0].T
+
+        # Backtracking on the residual, target by target
+        alpha = np.ones(step.shape[1])
+        norm_active = norm[active]
+
+        for ii in range(trim_halvings):
+            vars_new = vars[:,active] + alpha*step
+            res_new = residuals(vars_new, V[active], beta[active], model.kernel, jacobian=False)[0]
+            norm_new = np.max(np.abs(res_new), axis=0)
+
+            worse = ~(norm_new < norm_active)
+            if not np.any(worse):
+                break
+            alpha[worse] = alpha[worse]/2
+
+        # only the targets whose residual decreased move
+        improved = norm_new < norm_active
+        index = np.nonzero(active)[0]
+
+        vars[:,index[improved]] = vars_new[:,improved]
+        norm[index[improved]] = norm_new[improved]
+        stuck[index[~improved]] = True
+
+    return vars, norm <= trim_tol
+
+
+def trim_sweep(V_values, beta, model=None, guess=(0.1, 0.1, 5)):
+
+    # Continuation along a speed sweep: the equilibria at V_values[kk] (for every beta of the array beta)
+    # are solved starting from the extrapolation of the two previous speeds, so that the solutions
+    # stay on the branch found at V_values[0] from guess. The targets where the continuation fails
+    # (e.g. close to a speed where the equilibria with beta != 0 do not exist) are solved again from guess.
+    # Returns vars (3, len(V_values), len(beta)) and the boolean array of the converged ones
+
+    beta = np.atleast_1d(np.asarray(beta, dtype=float))
+    V_values = np.asarray(V_values, dtype=float)
+
+    vars = np.zeros((3, len(V_values), len(beta)))
+    converged = np.zeros((len(V_values), len(beta)), dtype=bool)
+
+    for kk, V in enumerate(V_values):
+
+        if kk == 0:
+            start = np.array(guess, dtype=float).reshape(3, -1) * np.ones((1, len(beta)))
+        elif kk == 1:
+            start = vars[:,0]
+        else:
+            # secant predictor
+            ratio = (V - V_values[kk-1])/(V_values[kk-1] - V_values[kk-2])
+            start = vars[:,kk-1] + ratio*(vars[:,kk-1] - vars[:,kk-2])
+
+        vars[:,kk], converged[kk] = trim_batch(V*np.ones(len(beta)), beta, model, start)
+
+        failed = ~converged[kk]
+        if kk > 0 and np.any(failed):
+            vars[:,kk,failed], converged[kk,failed] = trim_batch(V*np.ones(np.sum(failed)), beta[failed], model, guess)
+
+    return vars, converged
+
+
+#######################################
+# Trim table
+#######################################
+
+# Default grid of the trim table
+TABLE_V = np.linspace(1, 20, 96)
+TABLE_BETA = np.linspace(-0.3, 0.3, 61)
+
+_tables = {}    # tables already loaded in this process
+
+
+class TrimTable:
+
+    # Equilibria [psi dot, steering angle, force] on the grid V_grid x beta_grid, vars (3, nV, nbeta).
+    # Every speed is solved by continuation in beta starting from the straight motion (beta = 0, where
+    # the equilibrium is zero), so that the table follows the branch of the physical equilibria.
+    # The entries that did not converge are NaN
+
+    def __init__(self, V_grid, beta_grid, vars, model):
+
+        self.V_grid = np.asarray(V_grid, dtype=float)
+        self.beta_grid = np.asarray(beta_grid, dtype=float)
+        self.vars = vars
+        self.model = model
+
+        self.interpolant = RegularGridInterpolator((self.V_grid, self.beta_grid), np.moveaxis(vars, 0, -1))
+
+    @classmethod
+    def build(cls, V_grid, beta_grid, model=None):
+
+        if model is None:
+            model = dyn.model
+
+        V_grid = np.asarray(V_grid, dtype=float)
+        beta_grid = np.asarray(beta_grid, dtype=float)
+
+        vars = np.full((3, len(V_grid), len(beta_grid)), np.nan)
+
+        # betas sorted by distance from zero, separately on the two sides
+        order = np.argsort(np.abs(beta_grid))
+        for side in (beta_grid >= 0, beta_grid <= 0):
+            start = np.zeros((3, len(V_grid)))
+            for jj in order[side[order]]:
+                sol, converged = trim_batch(V_grid, beta_grid[jj]*np.ones(len(V_grid)), model, start)
+                sol[:,~converged] = np.nan
+                vars[:,:,jj] = sol
+                start = np.where(converged, sol, start)
+
+        return cls(V_grid, beta_grid, vars, model)
+
+    def query(self, V, beta, refine=False):
+
+        # Equilibria at the targets V, beta (arrays (N,) or scalars) interpolated linearly in the table,
+        # (3, N). The targets next to an entry that did not converge (speeds close to the one where the
+        # equilibria with beta != 0 do not exist) are solved with trim_batch() from the closest valid
+        # entry, and so are all the targets with refine = True, starting from the interpolated values.
+        # The targets where trim_batch() does not converge are NaN
+        V, beta = np.broadcast_arrays(np.atleast_1d(np.asarray(V, dtype=float)), np.asarray(beta, dtype=float))
+
+        vars = self.interpolant(np.column_stack((V, beta))).T
+
+        missing = np.isnan(vars[0])
+        if np.any(missing):
+            vars[:,missing] = self.nearest(V[missing], beta[missing])
+
+        solve = np.ones(len(V), dtype=bool) if refine else missing
+        if np.any(solve):
+            sol, converged = trim_batch(V[solve], beta[solve], self.model, vars[:,solve])
+            sol[:,~converged] = np.nan
+            vars[:,solve] = sol
+
+        return vars
+
+    def nearest(self, V, beta):
+
+        # Closest entries of the table that converged, (3, N)
+        valid = ~np.isnan(self.vars[0])
+        iV, ib = np.nonzero(valid)
+
+        scale = np.array([np.ptp(self.V_grid), np.ptp(self.beta_grid)])
+        nodes = np.column_stack((self.V_grid[iV], self.beta_grid[ib]))/scale
+        targets = np.column_stack((V, beta))/scale
+
+        ii = np.argmin(np.sum((targets[:,None,:] - nodes[None,:,:])**2, axis=2), axis=1)
+
+        return self.vars[:, iV[ii], ib[ii]]
+
+    def save(self, path):
+
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as file:
+            np.savez(file, V_grid=self.V_grid, beta_grid=self.beta_grid, vars=self.vars)
+        os.replace(temp_path, path)     # atomic, safe if several processes build the table at once
+
+    @classmethod
+    def load(cls, path, model):
+
+        with np.load(path) as data:
+            return cls(data['V_grid'], data['beta_grid'], data['vars'], model)
+
+
+def trim_table(model=None, V_grid=TABLE_V, beta_grid=TABLE_BETA):
+
+    # Trim table of the model (dyn.model if None), stored next to the generated kernels and rebuilt
+    # only if the parameters of the model, the grid or this file changed
+
+    if model is None:
+        model = dyn.model
+
+    with open(os.path.abspath(__file__), 'rb') as source:
+        data = source.read() + repr((model.kind, sorted(model.params.items()))).encode()
+    data += np.asarray(V_grid, dtype=float).tobytes() + np.asarray(beta_grid, dtype=float).tobytes()
+    key = hashlib.sha1(data).hexdigest()[:16]
+
+    if key in _tables:
+        return _tables[key]
+
+    path = os.path.join(Codegen.CACHE_DIR, 'trim_{}_{}.npz'.format(model.kind, key))
+
+    if os.path.exists(path):
+        table = TrimTable.load(path, model)
+    else:
+        table = TrimTable.build(V_grid, beta_grid, model)
+        try:
+            os.makedirs(Codegen.CACHE_DIR, exist_ok=True)
+            table.save(path)
+        except OSError:
+            pass    # read-only installation: keep the table in memory only
+
+    _tables[key] = table
+
+    return table
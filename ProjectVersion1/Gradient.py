@@ -10,16 +10,11 @@ import scipy as sp
 import matplotlib
 import matplotlib.pyplot as plt
 import Dynamics as dyn
+from Workspace import Workspace
 
 
 #define params
-ns = dyn.ns  # number of states
-ni = dyn.ni  # number of inputs
-dt = dyn.dt  # sample time
-
-TT = dyn.tf  # Final time in seconds
-T = dyn.TT  # Number of discrete-time samples
-T_mid = dyn.TT_mid
+# The dimensions and the dynamics are taken from the model passed to Gradient() (dyn.model by default)
 term_cond = 1e-6        #terminal condition
 
 # ARMIJO PARAMETERS
@@ -56,7 +51,33 @@ def cost_f(xx, xx_ref, QT):
 
     return lT.squeeze(), lTx
 
-def Gradient (xx, uu, xx_ref, uu_ref, Q, R, QT, max_iters):
+def Gradient (xx, uu, xx_ref, uu_ref, Q, R, QT, max_iters, model=None, ws=None):
+
+    # xx, uu: initial guess (ns, T), (ni, T), or (ns, T, max_iters), (ni, T, max_iters) arrays with the guess in [:,:,0]
+    # model: Dynamics.Model used for the rollouts and the linearizations, dyn.model if None.
+    #        The horizon T is the length of the reference
+    # ws:    Workspace whose rollout buffers hold the trajectories of the line search, allocated here if None
+
+    if model is None:
+        model = dyn.model
+
+    ns, ni = model.ns, model.ni
+    T = xx_ref.shape[1]
+
+    if ws is None:
+        ws = Workspace(ns, ni, T, 1)
+
+    ws.check(ns, ni, T)
+
+    if xx.ndim == 2:
+        # initial guess (ns, T), (ni, T) only: allocate the iterates
+        xx_init, uu_init = xx, uu
+
+        xx = np.zeros((ns, T, max_iters))
+        uu = np.zeros((ni, T, max_iters))
+
+        xx[:,:,0] = xx_init
+        uu[:,:,0] = uu_init
 
     # arrays to store data
     lmbd = np.zeros((ns, T, max_iters))    # lambdas - costate seq.
@@ -71,27 +92,26 @@ def Gradient (xx, uu, xx_ref, uu_ref, Q, R, QT, max_iters):
 
     for kk in range(max_iters-1):
 
-        JJ[kk] = 0
+        # calculate cost (from the second iteration on it comes from the line search)
+        if kk == 0:
+            for tt in range(T-1):
+                temp_cost = cost(xx[:,tt,kk], uu[:,tt,kk], xx_ref[:,tt], uu_ref[:,tt], Q, R)[0]
+                JJ[kk] += temp_cost
 
-        # calculate cost
-        for tt in range(T-1):
-            temp_cost = cost(xx[:,tt,kk], uu[:,tt,kk], xx_ref[:,tt], uu_ref[:,tt], Q, R)[0]
+            temp_cost = cost_f(xx[:,-1,kk], xx_ref[:,-1], QT)[0]
             JJ[kk] += temp_cost
 
-        temp_cost = cost_f(xx[:,-1,kk], xx_ref[:,-1], QT)[0]
-        JJ[kk] += temp_cost
-
         # Descent direction calculation
         lmbd_temp = cost_f(xx[:,T-1,kk], xx_ref[:,T-1], QT)[1]
         lmbd[:,T-1,kk] = lmbd_temp.squeeze()
 
+        A, B = model.linearize(xx[:,:,kk], uu[:,:,kk])
+
         for tt in reversed(range(T-1)):                        # integration backward in time
 
             at, bt = cost(xx[:,tt, kk], uu[:,tt,kk], xx_ref[:,tt], uu_ref[:,tt], Q, R)[1:]
-            fx, fu = dyn.dynamics(xx[:,tt,kk], uu[:,tt,kk])[1:]
-
-            At = fx.T
-            Bt = fu.T
+            At = A[:,:,tt]
+            Bt = B[:,:,tt]
 
             lmbd_temp = At.T@lmbd[:,tt+1,kk][:,None] + at       # costate equation
             dJ_temp = Bt.T@lmbd[:,tt+1,kk][:,None] + bt         # gradient of J wrt u
@@ -109,19 +129,20 @@ def Gradient (xx, uu, xx_ref, uu_ref, Q, R, QT, max_iters):
         costs_armijo = []
 
         stepsize = stepsize_0
+        xx_next = None      # trajectory accepted by the line search
 
         for ii in range(armijo_maxiters):
 
-            # temp solution update
+            # temp solution update, in the first rollout buffer of the workspace
 
-            xx_temp = np.zeros((ns,T))
-            uu_temp = np.zeros((ni,T))
+            xx_temp = ws.xx_temp[:,:,0]
+            uu_temp = ws.uu_temp[:,:,0]
 
             xx_temp[:,0] = x0
 
             for tt in range(T-1):
                 uu_temp[:,tt] = uu[:,tt,kk] + stepsize*deltau[:,tt,kk]
-                xx_temp[:,tt+1] = dyn.dynamics(xx_temp[:,tt], uu_temp[:,tt])[0]
+                xx_temp[:,tt+1] = model.next_state(xx_temp[:,tt], uu_temp[:,tt])
 
             # temp cost calculation
             JJ_temp = 0
@@ -142,6 +163,7 @@ def Gradient (xx, uu, xx_ref, uu_ref, Q, R, QT, max_iters):
 
             else:
                 print('Armijo stepsize = {:.3e}'.format(stepsize))
+                xx_next, uu_next, JJ_next = xx_temp, uu_temp, JJ_temp
                 break
 
         # Armijo plot
@@ -163,7 +185,7 @@ def Gradient (xx, uu, xx_ref, uu_ref, Q, R, QT, max_iters):
 
                 for tt in range(T-1):
                     uu_temp[:,tt] = uu[:,tt,kk] + step*deltau[:,tt,kk]
-                    xx_temp[:,tt+1] = dyn.dynamics(xx_temp[:,tt], uu_temp[:,tt])[0]
+                    xx_temp[:,tt+1] = model.next_state(xx_temp[:,tt], uu_temp[:,tt])
 
                 # temp cost calculation
                 JJ_temp = 0
@@ -189,19 +211,28 @@ def Gradient (xx, uu, xx_ref, uu_ref, Q, R, QT, max_iters):
             plt.draw()
             plt.show()
 
-        # Update the current solution
+        # Update the current solution, reusing the trajectory and the cost accepted by the line search
+
+        if xx_next is None:
+            xx_next = ws.xx_temp[:,:,0]
+            uu_next = ws.uu_temp[:,:,0]
 
-        xx_temp = np.zeros((ns,T))
-        uu_temp = np.zeros((ni,T))
+            xx_next[:,0] = x0
 
-        xx_temp[:,0] = x0
+            for tt in range(T-1):
+                uu_next[:,tt] = uu[:,tt,kk] + stepsize*deltau[:,tt,kk]
+                xx_next[:,tt+1] = model.next_state(xx_next[:,tt], uu_next[:,tt])
+
+            JJ_next = 0
+
+            for tt in range(T-1):
+                JJ_next += cost(xx_next[:,tt], uu_next[:,tt], xx_ref[:,tt], uu_ref[:,tt], Q, R)[0]
 
-        for tt in range(T-1):
-            uu_temp[:,tt] = uu[:,tt,kk] + stepsize*deltau[:,tt,kk]
-            xx_temp[:,tt+1] = dyn.dynamics(xx_temp[:,tt], uu_temp[:,tt])[0]
+            JJ_next += cost_f(xx_next[:,-1], xx_ref[:,-1], QT)[0]
 
-        xx[:,:,kk+1] = xx_temp
-        uu[:,:,kk+1] = uu_temp
+        xx[:,:,kk+1] = xx_next
+        uu[:,:,kk+1] = uu_next
+        JJ[kk+1] = JJ_next
 
         # Termination condition
 
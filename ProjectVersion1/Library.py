@@ -0,0 +1,166 @@
+#
+# Optimal Control of a Vehicle
+# Library of Optimal Maneuvers between Cornering Equilibria
+# Rapallini Antonio & Bertamè Sebastiano
+# Bologna, 04/01/2024
+#
+
+import os
+import itertools
+import numpy as np
+import Dynamics as dyn
+import Costs as cst
+import Newton as nwtn
+import Reference as rf
+from Workspace import Workspace
+
+
+#######################################
+# Reference of a maneuver
+#######################################
+
+def reference(V0, beta0, V1, beta1, model=None):
+
+    # Step reference of Task 1 from the cornering equilibrium (V0, beta0) to (V1, beta1): V, beta,
+    # psi dot and the inputs switch at half horizon, x, y and psi are integrated along it (Reference.py).
+    # Returns xx_ref (ns, TT) and uu_ref (ni, TT)
+    if model is None:
+        model = dyn.model
+
+    ns, TT, dt = model.ns, model.TT, model.dt
+
+    traj_ref = rf.reference([(V0, beta0, model.TT_mid*dt), (V1, beta1, (TT-model.TT_mid)*dt)], model)[0]
+
+    return traj_ref[:ns], traj_ref[ns:]
+
+
+#######################################
+# Offline builder
+#######################################
+
+def build(path, V_grid, beta_grid, model=None, max_iters=30, exact_hessian=True, QQ_reg=None, RR_reg=None, QQf_reg=None):
+
+    # Solve the Newton's problem of every transition between two different equilibria of the grid
+    # V_grid x beta_grid and save the optimal trajectories xx_star, uu_star together with the gains of
+    # the LQR tracking them (weights QQ_reg, RR_reg, QQf_reg, the cost matrices by default) to the
+    # .npz file path. Every problem is started from the constant initial guess of main.py: the
+    # solutions of the other maneuvers start from a different state and are worse initial guesses.
+    # Returns the ManeuverLibrary
+
+    if model is None:
+        model = dyn.model
+
+    QQ_reg = cst.QQt if QQ_reg is None else QQ_reg
+    RR_reg = cst.RRt if RR_reg is None else RR_reg
+    QQf_reg = cst.QQT if QQf_reg is None else QQf_reg
+
+    ns, ni, TT = model.ns, model.ni, model.TT
+
+    points = list(itertools.product(V_grid, beta_grid))
+    pairs = np.array([p0 + p1 for p0, p1 in itertools.product(points, points) if p0 != p1], dtype=float)
+    NN = len(pairs)
+
+    xx_star = np.zeros((NN, ns, TT))
+    uu_star = np.zeros((NN, ni, TT))
+    KK_reg = np.zeros((NN, ni, ns, TT))
+    cost = np.zeros(NN)
+    iters = np.zeros(NN, dtype=int)
+    converged = np.zeros(NN, dtype=bool)
+
+    ws = Workspace(ns, ni, TT, nwtn.armijo_batch)
+
+    for ii, (V0, beta0, V1, beta1) in enumerate(pairs):
+
+        print('Maneuver {}/{}: (V, beta) = ({}, {}) -> ({}, {})'.format(ii+1, NN, V0, beta0, V1, beta1))
+
+        xx_ref, uu_ref = reference(V0, beta0, V1, beta1, model)
+
+        xx_init = np.repeat(xx_ref[:,[0]], TT, axis=1)
+        uu_init = np.repeat(uu_ref[:,[0]], TT, axis=1)
+
+        xx, uu, descent, JJ, kk = nwtn.Newton(xx_init, uu_init, xx_ref, uu_ref, xx_ref[:,0].copy(), max_iters,
+                                              exact_hessian=exact_hessian, model=model, ws=ws, history='final')
+
+        AA, BB = model.linearize(xx, uu)
+        KK_reg[ii] = nwtn.ltv_LQR(AA, BB, QQ_reg, RR_reg, np.zeros((ni, ns)), QQf_reg, TT, np.zeros(ns))[2]
+
+        xx_star[ii] = xx
+        uu_star[ii] = uu
+        cost[ii] = JJ[kk+1]
+        iters[ii] = kk+1
+        converged[ii] = descent[kk] <= nwtn.term_cond
+
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as file:
+        np.savez_compressed(file, pairs=pairs, xx=xx_star, uu=uu_star, KK=KK_reg, cost=cost, iters=iters,
+                            converged=converged, model=repr(model))
+    os.replace(temp_path, path)     # atomic, as in Codegen.py
+
+    return ManeuverLibrary(path)
+
+
+#######################################
+# Online query
+#######################################
+
+class ManeuverLibrary:
+
+    # Maneuvers saved by build(), indexed by the transition (V0, beta0, V1, beta1). The distance between
+    # two transitions is measured with every coordinate scaled by its range in the library. The queries
+    # skip the maneuvers whose Newton's method did not converge, unless none did
+
+    def __init__(self, path):
+
+        with np.load(path) as data:
+            self.pairs = data['pairs']
+            self.xx = data['xx']
+            self.uu = data['uu']
+            self.KK = data['KK']
+            self.cost = data['cost']
+            self.iters = data['iters']
+            self.converged = data['converged']
+            self.model = str(data['model'])
+
+        scale = np.ptp(self.pairs, axis=0)
+        self.scale = np.where(scale > 0, scale, 1.0)
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def distances(self, V0, beta0, V1, beta1):
+
+        dd = np.linalg.norm((self.pairs - np.array([V0, beta0, V1, beta1]))/self.scale, axis=1)
+
+        if np.any(self.converged):
+            dd[~self.converged] = np.inf
+
+        return dd
+
+    def nearest(self, V0, beta0, V1, beta1):
+
+        # Closest stored maneuver: xx_star (ns, TT), uu_star (ni, TT), gains KK (ni, ns, TT) and its distance
+        dd = self.distances(V0, beta0, V1, beta1)
+        ii = np.argmin(dd)
+
+        return self.xx[ii], self.uu[ii], self.KK[ii], dd[ii]
+
+    def interpolate(self, V0, beta0, V1, beta1, neighbours=4):
+
+        # Inverse-distance weighted blend of the closest stored maneuvers, the stored one if the
+        # transition is in the library. The result is an approximation (e.g. an initial guess for
+        # Newton()), it is not a trajectory of the dynamics
+        dd = self.distances(V0, beta0, V1, beta1)
+        near = np.argsort(dd)[:neighbours]
+
+        if dd[near[0]] == 0:
+            ii = near[0]
+            return self.xx[ii], self.uu[ii], self.KK[ii]
+
+        ww = 1/dd[near]
+        ww = ww/np.sum(ww)
+
+        xx = np.tensordot(ww, self.xx[near], axes=1)
+        uu = np.tensordot(ww, self.uu[near], axes=1)
+        KK = np.tensordot(ww, self.KK[near], axes=1)
+
+        return xx, uu, KK
@@ -0,0 +1,568 @@
+#
+# Optimal Control of a Vehicle
+# Model Predictive Control
+# Rapallini Antonio & Bertamè Sebastiano
+# Bologna, 04/01/2024
+#
+
+import time
+from collections import OrderedDict
+import numpy as np
+import cvxpy as cp
+import osqp
+from scipy import sparse, linalg
+import Newton as nwtn
+from Workspace import Workspace
+
+
+class LinearMPC:
+
+    # Linear MPC tracking a reference on the prediction horizon T_pred with the linearizations AA, BB
+    # of the model along it:
+    #   min  sum_{t<T_pred-1} |xx_t - xx_ref_t|^2_QQ + |uu_t - uu_ref_t|^2_RR  +  |xx_T_pred-1 - xx_ref_T_pred-1|^2_QQf
+    #   s.t. xx_0 = xx0,  xx_t+1 = AA_t xx_t + BB_t uu_t,  uu_t[1] <= umax
+    # The cvxpy problem is built once: the initial state, the reference and the matrices of the
+    # dynamics are cp.Parameter, so that every solve() only updates their values and cvxpy reuses
+    # the canonicalization of the first solve. To keep the problem DPP the reference enters the cost
+    # through the linear terms qq = -2 QQ xx_ref, rr = -2 RR uu_ref (the constant terms are dropped,
+    # problem.value is not the tracking cost)
+
+    def __init__(self, ns, ni, T_pred, QQ, RR, QQf, umax=np.inf):
+
+        self.ns = ns
+        self.ni = ni
+        self.T_pred = T_pred
+        self.QQ = QQ
+        self.RR = RR
+        self.QQf = QQf
+
+        self.xx0 = cp.Parameter(ns)
+        self.qq = cp.Parameter((ns, T_pred))
+        self.rr = cp.Parameter((ni, T_pred))
+        self.AA = [cp.Parameter((ns, ns)) for tt in range(T_pred-1)]
+        self.BB = [cp.Parameter((ns, ni)) for tt in range(T_pred-1)]
+
+        self.xx = cp.Variable((ns, T_pred))
+        self.uu = cp.Variable((ni, T_pred))
+
+        cost = 0
+        constr = []
+        for tt in range(T_pred-1):
+            cost += cp.quad_form(self.xx[:,tt], QQ) + self.qq[:,tt]@self.xx[:,tt] + cp.quad_form(self.uu[:,tt], RR) + self.rr[:,tt]@self.uu[:,tt]
+            constr += [self.xx[:,tt+1] == self.AA[tt]@self.xx[:,tt] + self.BB[tt]@self.uu[:,tt]]     # dynamics constraint
+            if np.isfinite(umax):
+                constr += [self.uu[1,tt] <= umax]                                                   # bound on the force
+
+        cost += cp.quad_form(self.xx[:,T_pred-1], QQf) + self.qq[:,T_pred-1]@self.xx[:,T_pred-1]
+        constr += [self.xx[:,0] == self.xx0]
+
+        self.problem = cp.Problem(cp.Minimize(cost), constr)
+
+    def solve(self, xx0, AA, BB, xx_ref, uu_ref, tl=0, **kwargs):
+
+        # MPC at time tl from the state xx0: AA (ns, ns, TT), BB (ns, ni, TT), xx_ref (ns, TT) and
+        # uu_ref (ni, TT) are the whole trajectories, the window tl:tl+T_pred is used.
+        # kwargs are passed to problem.solve(). Returns the first input and the predicted trajectories
+        T_pred = self.T_pred
+
+        self.xx0.value = np.asarray(xx0, dtype=float).squeeze()
+        self.qq.value = np.column_stack((-2*self.QQ@xx_ref[:, tl:tl+T_pred-1], -2*self.QQf@xx_ref[:, tl+T_pred-1]))
+        self.rr.value = np.column_stack((-2*self.RR@uu_ref[:, tl:tl+T_pred-1], np.zeros(self.ni)))   # no cost on the last input
+        for tt in range(T_pred-1):
+            self.AA[tt].value = AA[:,:,tl+tt]
+            self.BB[tt].value = BB[:,:,tl+tt]
+
+        self.problem.solve(**kwargs)
+
+        if self.problem.status == "infeasible":
+        # Otherwise, problem.value is inf or -inf, respectively.
+            print("Infeasible problem! CHECK YOUR CONSTRAINTS!!!")
+
+        return self.uu[:,0].value, self.xx.value, self.uu.value
+
+
+class OsqpMPC:
+
+    # The problem of LinearMPC solved directly with OSQP, written in the deviations from the reference
+    # dxx = xx - xx_ref, duu = uu - uu_ref (better scaled than the absolute values):
+    #   min  sum_{t<T_pred-1} |dxx_t|^2_QQ + |duu_t|^2_RR  +  |dxx_T_pred-1|^2_QQf
+    #   s.t. dxx_0 = xx0 - xx_ref_0,  dxx_t+1 = AA_t dxx_t + BB_t duu_t + cc_t,  duu_t[1] <= umax - uu_ref_t[1]
+    # with cc_t = AA_t xx_ref_t + BB_t uu_ref_t - xx_ref_t+1. The last input is not in the problem (it has
+    # no cost and no effect), it is returned equal to the reference.
+    # The OSQP workspace is set up once with a fixed sparsity pattern: a solve only updates the entries
+    # of AA, BB (the KKT matrix is factorized again only if they changed) and the vectors, and starts
+    # from the previous solution shifted by one step if the window moved forward by one step, from the
+    # previous solution itself if the window did not move
+
+    def __init__(self, ns, ni, T_pred, QQ, RR, QQf, umax=np.inf, **settings):
+
+        self.ns = ns
+        self.ni = ni
+        self.T_pred = T_pred
+        self.umax = umax
+
+        nx = ns*T_pred              # dxx_0, ..., dxx_T_pred-1
+        nu = ni*(T_pred-1)          # duu_0, ..., duu_T_pred-2
+        self.nx = nx
+
+        PP = 2*sparse.block_diag([sparse.kron(sparse.eye(T_pred-1), QQ), QQf, sparse.kron(sparse.eye(T_pred-1), RR)], format='csc')
+
+        # Constraints: rows of the dynamics (the first block is the initial state), then the bounds on the force
+        steps = np.arange(T_pred-1)
+        ii, jj = np.arange(ns), np.arange(ns)
+        rows = [np.arange(nx),
+                ((steps[:,None,None]+1)*ns + ii[:,None] + 0*jj).ravel(),
+                ((steps[:,None,None]+1)*ns + ii[:,None] + 0*np.arange(ni)).ravel(),
+                nx + steps]
+        cols = [np.arange(nx),
+                (steps[:,None,None]*ns + 0*ii[:,None] + jj).ravel(),
+                (nx + steps[:,None,None]*ni + 0*ii[:,None] + np.arange(ni)).ravel(),
+                nx + steps*ni + 1]
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+
+        # position in the CSC data of every entry, listed as [identity, AA_t, BB_t, bounds]
+        labels = sparse.coo_matrix((np.arange(1, len(rows)+1, dtype=float), (rows, cols)), shape=(nx + T_pred-1, nx + nu)).tocsc()
+        self.order = labels.data.astype(int) - 1
+        self.Ax = None
+
+        self.lower = np.zeros(nx + T_pred-1)
+        self.upper = np.zeros(nx + T_pred-1)
+        self.lower[nx:] = -np.inf
+
+        settings.setdefault('verbose', False)
+        self.solver = osqp.OSQP()
+        self.solver.setup(PP, np.zeros(nx + nu), labels, self.lower, self.upper, **settings)
+
+        self.tl = None
+        self.zz = None      # previous solution, primal
+        self.yy = None      # and dual
+
+    def solve(self, xx0, AA, BB, xx_ref, uu_ref, tl=0):
+
+        # Same inputs and outputs as LinearMPC.solve()
+        ns, ni, T_pred, nx = self.ns, self.ni, self.T_pred, self.nx
+
+        AA_w = np.moveaxis(AA[:,:,tl:tl+T_pred-1], -1, 0)
+        BB_w = np.moveaxis(BB[:,:,tl:tl+T_pred-1], -1, 0)
+        xx_w = xx_ref[:, tl:tl+T_pred]
+        uu_w = uu_ref[:, tl:tl+T_pred-1]
+
+        Ax = np.concatenate((np.ones(nx), -AA_w.ravel(), -BB_w.ravel(), np.ones(T_pred-1)))[self.order]
+        if self.Ax is None or not np.array_equal(Ax, self.Ax):
+            self.solver.update(Ax=Ax)
+            self.Ax = Ax
+
+        cc = np.einsum('tij,jt->it', AA_w, xx_w[:,:-1]) + np.einsum('tij,jt->it', BB_w, uu_w) - xx_w[:,1:]
+        self.lower[:ns] = np.asarray(xx0, dtype=float).squeeze() - xx_w[:,0]
+        self.lower[ns:nx] = cc.T.ravel()
+        self.upper[:nx] = self.lower[:nx]
+        self.upper[nx:] = self.umax - uu_w[1]
+        self.solver.update(l=self.lower, u=self.upper)
+
+        if self.zz is not None and tl == self.tl + 1:
+            self.solver.warm_start(x=self.shift(self.zz, ni), y=self.shift(self.yy, 1))
+        elif self.zz is not None and tl == self.tl:
+            self.solver.warm_start(x=self.zz, y=self.yy)
+
+        res = self.solver.solve()
+
+        if res.info.status == "primal infeasible":
+            print("Infeasible problem! CHECK YOUR CONSTRAINTS!!!")
+
+        self.tl, self.zz, self.yy = tl, res.x, res.y
+        self.info = res.info
+
+        xx = xx_w + res.x[:nx].reshape(T_pred, ns).T
+        uu = np.column_stack((uu_w + res.x[nx:].reshape(T_pred-1, ni).T, uu_ref[:, tl+T_pred-1]))
+
+        return uu[:,0], xx, uu
+
+    def shift(self, zz, nb):
+
+        # Solution of the previous window moved one step forward, the last step repeated: the states (and
+        # the multipliers of the dynamics) by ns, the inputs by ni (the multipliers of the bounds by nb = 1)
+        ns, nx = self.ns, self.nx
+        xx, uu = zz[:nx], zz[nx:]
+
+        return np.concatenate((xx[ns:], xx[-ns:], uu[nb:], uu[-nb:]))
+
+
+class RiccatiMPC:
+
+    # The problem of LinearMPC solved with a primal-dual active-set method on the Riccati recursion:
+    # every iteration fixes the force at umax on the stages of the active set and solves the resulting
+    # equality constrained problem with ltv_LQR in O(T_pred), with the fixed forces moved into the affine
+    # term of the dynamics. Then the multipliers of the bound are computed from the costates, the stages
+    # with a negative multiplier leave the active set and the ones exceeding the bound enter it. When the
+    # active set does not change the solution satisfies the KKT conditions of the QP, so it is the one of
+    # LinearMPC. The method starts from the active set of the previous solve, shifted by one step if the
+    # window moved forward by one step, so that in a receding-horizon loop one or two iterations are enough
+
+    def __init__(self, ns, ni, T_pred, QQ, RR, QQf, umax=np.inf, max_iters=50, tol=1e-9):
+
+        self.ns = ns
+        self.ni = ni
+        self.T_pred = T_pred
+        self.umax = umax
+        self.max_iters = max_iters
+        self.tol = tol
+
+        # ltv_LQR minimizes 0.5 x'Qx + q'x + 0.5 u'Ru + r'u, the costs of LinearMPC have no 0.5
+        self.QQ = 2*QQ
+        self.RR = 2*RR
+        self.QQf = 2*QQf
+
+        self.ws = Workspace(ns, ni, T_pred)
+
+        # Stage matrices of ltv_LQR, only the entries of the active stages are changed
+        self.RR_w = np.repeat(self.RR[:,:,None], T_pred, axis=2)
+        self.BB_w = np.zeros((ns, ni, T_pred))
+        self.cc_w = np.zeros((ns, T_pred))
+
+        self.tl = None
+        self.active = np.zeros(T_pred-1, dtype=bool)     # stages with the force at umax
+        self.iters = 0
+
+    def solve(self, xx0, AA, BB, xx_ref, uu_ref, tl=0):
+
+        # Same inputs and outputs as LinearMPC.solve(), the number of iterations is stored in self.iters
+        T_pred, umax = self.T_pred, self.umax
+
+        AA_w = AA[:,:,tl:tl+T_pred]
+        BB_w = BB[:,:,tl:tl+T_pred]
+        xx_w = xx_ref[:, tl:tl+T_pred]
+        uu_w = uu_ref[:, tl:tl+T_pred]
+        xx0 = np.asarray(xx0, dtype=float).squeeze()
+
+        qq = -self.QQ @ xx_w
+        rr = -self.RR @ uu_w
+        qqf = -self.QQf @ xx_w[:,-1]
+
+        self.active = initial_active(self.active, self.tl, tl)
+
+        for kk in range(self.max_iters):
+
+            active = self.active
+            xx, uu = self.equality_lqr(xx0, AA_w, BB_w, qq, rr, qqf, active)
+
+            # Multipliers of the bound on the active stages, from the gradient of the Lagrangian wrt the force
+            lmbd = self.QQf @ xx[:,-1] + qqf
+            mu = np.zeros(T_pred-1)
+            for tt in reversed(range(T_pred-1)):
+                mu[tt] = -(self.RR[1] @ uu[:,tt] + rr[1,tt] + BB_w[:,1,tt] @ lmbd)
+                lmbd = self.QQ @ xx[:,tt] + qq[:,tt] + AA_w[:,:,tt].T @ lmbd
+
+            new_active = next_active(active, mu, uu[1,:-1], umax, self.tol)
+
+            if np.array_equal(new_active, active):
+                break
+            self.active = new_active
+        else:
+            print("RiccatiMPC: active set not found in {} iterations".format(self.max_iters))
+
+        self.tl = tl
+        self.iters = kk+1
+
+        uu[:,-1] = uu_w[:,-1]       # the last input has no cost and no effect
+
+        return uu[:,0], xx, uu
+
+    def equality_lqr(self, xx0, AA_w, BB_w, qq, rr, qqf, active):
+
+        # Solution with the force fixed at umax on the active stages: on those stages the force has no
+        # effect in ltv_LQR (zero column of B, unit weight, no coupling with the steering angle) and its
+        # contribution is moved into the affine term of the dynamics and the gradient of the other inputs
+        ns, ni, umax = self.ns, self.ni, self.umax
+
+        tt = np.nonzero(active)[0]
+        free = np.arange(ni) != 1
+
+        RR_w, BB_c, cc_w = self.RR_w, self.BB_w, self.cc_w
+        RR_w[:] = self.RR[:,:,None]
+        BB_c[:] = BB_w
+        cc_w[:] = 0
+        rr_w = rr.copy()
+
+        cc_w[:,tt] = BB_w[:,1,tt]*umax
+        rr_w[np.ix_(free, tt)] += self.RR[free,1][:,None]*umax
+        rr_w[1,tt] = 0
+        RR_w[1,:,tt] = 0
+        RR_w[:,1,tt] = 0
+        RR_w[1,1,tt] = 1
+        BB_c[:,1,tt] = 0
+
+        xx, uu = nwtn.ltv_LQR(AA_w, BB_c, self.QQ, RR_w, np.zeros((ni, ns)), self.QQf, self.T_pred, xx0,
+                              qq, rr_w, qqf, cc_w, self.ws)[:2]
+
+        xx, uu = xx.copy(), uu.copy()       # views of the workspace
+        uu[1,tt] = umax
+
+        return xx, uu
+
+
+class CondensedMPC:
+
+    # The problem of LinearMPC condensed in the inputs only: the predicted states are eliminated with the
+    # prediction matrices of the window, xx_t = Phi_t xx0 + Gamma_t UU with UU = [uu_0; ...; uu_T_pred-2],
+    # and the dense QP  min 0.5 UU'HH UU + gg'UU  s.t. the force <= umax  is solved with the primal-dual
+    # active-set method of RiccatiMPC (Cholesky of the free block of HH), starting from the previous
+    # active set. Phi, Gamma and HH only depend on the window of AA, BB: they are built once for every
+    # window start tl and kept for the last capacity windows, so that solving the same window again
+    # (e.g. from other initial states) only costs the gradient and the active-set iterations.
+    # Building a window is O(T_pred^2) in memory and O(T_pred^3) in time, against the O(T_pred) of
+    # RiccatiMPC: the condensed problem pays off for short horizons only (see controller())
+
+    def __init__(self, ns, ni, T_pred, QQ, RR, QQf, umax=np.inf, capacity=64, max_iters=50, tol=1e-9):
+
+        self.ns = ns
+        self.ni = ni
+        self.T_pred = T_pred
+        self.umax = umax
+        self.capacity = capacity
+        self.max_iters = max_iters
+        self.tol = tol
+
+        self.QQ = QQ
+        self.RR = RR
+        self.QQf = QQf
+
+        nu = ni*(T_pred-1)
+        self.force = np.arange(T_pred-1)*ni + 1         # entries of UU bounded by umax
+        self.RRbar = np.kron(np.eye(T_pred-1), RR)
+
+        self.windows = OrderedDict()    # tl -> (AA, BB, Phi, Gamma, WGamma, HH), most recent last
+
+        self.tl = None
+        self.active = np.zeros(T_pred-1, dtype=bool)
+        self.iters = 0
+
+    def prediction(self, AA, BB, tl):
+
+        # Prediction matrices of the window tl:tl+T_pred, Phi (T_pred, ns, ns) and Gamma (T_pred, ns, nu),
+        # the weighted WGamma_t = QQ_t Gamma_t and the Hessian HH = 2 (sum_t Gamma_t' QQ_t Gamma_t + RRbar).
+        # A cached window is used only if it was built from the same arrays AA, BB
+        entry = self.windows.get(tl)
+        if entry is not None and entry[0] is AA and entry[1] is BB:
+            self.windows.move_to_end(tl)
+            return entry[2:]
+
+        ns, ni, T_pred = self.ns, self.ni, self.T_pred
+
+        Phi = np.zeros((T_pred, ns, ns))
+        Gamma = np.zeros((T_pred, ns, ni*(T_pred-1)))
+        Phi[0] = np.eye(ns)
+        for tt in range(1, T_pred):
+            Phi[tt] = AA[:,:,tl+tt-1] @ Phi[tt-1]
+            Gamma[tt] = AA[:,:,tl+tt-1] @ Gamma[tt-1]
+            Gamma[tt, :, (tt-1)*ni:tt*ni] += BB[:,:,tl+tt-1]
+
+        WGamma = np.empty_like(Gamma)
+        WGamma[:-1] = np.einsum('ij,tjk->tik', self.QQ, Gamma[:-1])
+        WGamma[-1] = self.QQf @ Gamma[-1]
+
+        HH = 2*(np.einsum('tia,tib->ab', Gamma, WGamma) + self.RRbar)
+
+        self.windows[tl] = (AA, BB, Phi, Gamma, WGamma, HH)
+        while len(self.windows) > self.capacity:
+            self.windows.popitem(last=False)
+
+        return Phi, Gamma, WGamma, HH
+
+    def solve(self, xx0, AA, BB, xx_ref, uu_ref, tl=0):
+
+        # Same inputs and outputs as LinearMPC.solve(), the number of iterations is stored in self.iters
+        ns, ni, T_pred, umax = self.ns, self.ni, self.T_pred, self.umax
+
+        Phi, Gamma, WGamma, HH = self.prediction(AA, BB, tl)
+
+        xx_w = xx_ref[:, tl:tl+T_pred]
+        uu_w = uu_ref[:, tl:tl+T_pred]
+        xx0 = np.asarray(xx0, dtype=float).squeeze()
+
+        # Gradient at UU = 0
+        ee = Phi @ xx0 - xx_w.T
+        gg = 2*(np.einsum('tia,ti->a', WGamma, ee) - self.RRbar @ uu_w[:,:-1].T.ravel())
+
+        force = self.force
+        UU = np.zeros(ni*(T_pred-1))
+
+        self.active = initial_active(self.active, self.tl, tl)
+
+        for kk in range(self.max_iters):
+
+            active = self.active
+            fixed = force[active]
+            free = np.ones(len(UU), dtype=bool)
+            free[fixed] = False
+
+            UU[fixed] = umax
+            rhs = -(gg[free] + HH[np.ix_(free, fixed)] @ UU[fixed])
+            UU[free] = linalg.cho_solve(linalg.cho_factor(HH[np.ix_(free, free)]), rhs)
+
+            # Multipliers of the bound on the active stages
+            mu = np.zeros(T_pred-1)
+            mu[active] = -(HH[fixed] @ UU + gg[fixed])
+
+            new_active = next_active(active, mu, UU[force], umax, self.tol)
+
+            if np.array_equal(new_active, active):
+                break
+            self.active = new_active
+        else:
+            print("CondensedMPC: active set not found in {} iterations".format(self.max_iters))
+
+        self.tl = tl
+        self.iters = kk+1
+
+        xx = (Phi @ xx0 + Gamma @ UU).T
+        uu = np.column_stack((UU.reshape(T_pred-1, ni).T, uu_w[:,-1]))     # the last input has no cost and no effect
+
+        return uu[:,0], xx, uu
+
+
+#######################################
+# Choice of the solver
+#######################################
+
+_choices = {}       # (ns, ni, T_pred) -> method chosen by benchmark() in this process
+
+
+def controller(ns, ni, T_pred, QQ, RR, QQf, umax=np.inf, method='auto', sample=None):
+
+    # MPC solver of the problem of LinearMPC: 'sparse' (RiccatiMPC), 'condensed' (CondensedMPC) or 'auto',
+    # the faster one for this horizon according to benchmark() on sample = (xx0, AA, BB, xx_ref, uu_ref)
+    if method == 'auto':
+        if sample is None:
+            raise ValueError("controller: method 'auto' needs a sample problem to benchmark")
+        method = benchmark(ns, ni, T_pred, QQ, RR, QQf, umax, sample)
+
+    if method == 'sparse':
+        return RiccatiMPC(ns, ni, T_pred, QQ, RR, QQf, umax)
+    if method == 'condensed':
+        return CondensedMPC(ns, ni, T_pred, QQ, RR, QQf, umax)
+
+    raise ValueError("controller: unknown method '{}'".format(method))
+
+
+def benchmark(ns, ni, T_pred, QQ, RR, QQf, umax, sample, steps=5):
+
+    # Time both solvers on the first steps windows of the sample problem, as in a receding-horizon loop
+    # (a new window every step, so the condensed one also builds its prediction matrices).
+    # The choice is kept for the size (ns, ni, T_pred)
+    key = (ns, ni, T_pred)
+    if key in _choices:
+        return _choices[key]
+
+    xx0, AA, BB, xx_ref, uu_ref = sample
+    steps = min(steps, xx_ref.shape[1] - T_pred + 1)
+
+    times = {}
+    for method in ('sparse', 'condensed'):
+        mpc = controller(ns, ni, T_pred, QQ, RR, QQf, umax, method)
+        start = time.perf_counter()
+        for tl in range(steps):
+            mpc.solve(xx0, AA, BB, xx_ref, uu_ref, tl)
+        times[method] = time.perf_counter() - start
+
+    _choices[key] = min(times, key=times.get)
+
+    return _choices[key]
+
+
+#######################################
+# End of the reference
+#######################################
+
+class HorizonMPC:
+
+    # MPC on a reference of finite length TT, feedback up to the last step: the windows tl:tl+T_pred
+    # that go past the end of the reference are solved
+    #   mode = 'shrink': with the horizon TT - tl, the prediction ends with the reference
+    #   mode = 'extend': with the horizon T_pred, the reference and the matrices extended by holding
+    #                    their last sample
+    # The solvers are built by controller() (method 'auto' is benchmarked once, for T_pred) and kept
+    # for every horizon length, so that running the loop again builds nothing. When the horizon
+    # shrinks, the new solver starts from the active set of the previous one
+
+    def __init__(self, ns, ni, T_pred, QQ, RR, QQf, umax=np.inf, method='auto', sample=None, mode='shrink'):
+
+        if mode not in ('shrink', 'extend'):
+            raise ValueError("HorizonMPC: unknown mode '{}'".format(mode))
+
+        self.ns = ns
+        self.ni = ni
+        self.T_pred = T_pred
+        self.args = (QQ, RR, QQf, umax)
+        self.mode = mode
+
+        self.solvers = {T_pred: controller(ns, ni, T_pred, QQ, RR, QQf, umax, method, sample)}
+        self.method = 'condensed' if isinstance(self.solvers[T_pred], CondensedMPC) else 'sparse'
+
+        self.extended = None    # (AA, BB, xx_ref, uu_ref) and their extensions for mode 'extend'
+        self.last = None        # solver of the previous step
+
+    def solver(self, T):
+
+        # Solver with horizon T, built once
+        if T not in self.solvers:
+            self.solvers[T] = controller(self.ns, self.ni, T, *self.args, method=self.method)
+
+        return self.solvers[T]
+
+    def extend(self, AA, BB, xx_ref, uu_ref):
+
+        # Arrays extended by T_pred-1 samples equal to the last one, computed once for the same arrays
+        if self.extended is None or any(aa is not bb for aa, bb in zip(self.extended[0], (AA, BB, xx_ref, uu_ref))):
+            hold = lambda MM: np.concatenate((MM, np.repeat(MM[...,-1:], self.T_pred-1, axis=-1)), axis=-1)
+            self.extended = ((AA, BB, xx_ref, uu_ref), tuple(hold(MM) for MM in (AA, BB, xx_ref, uu_ref)))
+
+        return self.extended[1]
+
+    def solve(self, xx0, AA, BB, xx_ref, uu_ref, tl=0):
+
+        # Same inputs and outputs as LinearMPC.solve(), the predicted trajectories have TT - tl samples
+        # if the horizon shrinks. tl must be at most TT-2, so that there is at least one input
+        TT = xx_ref.shape[1]
+        if not 0 <= tl <= TT-2:
+            raise ValueError('HorizonMPC: window start {} out of the reference of length {}'.format(tl, TT))
+
+        if self.mode == 'extend':
+            mpc = self.solvers[self.T_pred]
+            AA, BB, xx_ref, uu_ref = self.extend(AA, BB, xx_ref, uu_ref)
+        else:
+            mpc = self.solver(min(self.T_pred, TT - tl))
+
+            if mpc is not self.last and self.last is not None and self.last.tl == tl-1:
+                # same end of the window, the previous active set without its first stage
+                mpc.active = self.last.active[1:].copy()
+                mpc.tl = tl
+
+        self.last = mpc
+
+        return mpc.solve(xx0, AA, BB, xx_ref, uu_ref, tl)
+
+
+#######################################
+# Active set
+#######################################
+
+def initial_active(active, tl_prev, tl):
+
+    # Active set to start from at the window tl: the one of the previous window tl_prev shifted by one
+    # step (the last stage repeated) if the window moved forward by one step, the same if it did not move,
+    # empty otherwise
+    if tl_prev is not None and tl == tl_prev + 1:
+        return np.append(active[1:], active[-1])
+    if tl_prev == tl:
+        return active
+
+    return np.zeros_like(active)
+
+
+def next_active(active, mu, force, umax, tol):
+
+    # Primal-dual active-set update: the active stages with a negative multiplier mu leave the set,
+    # the inactive stages whose force exceeds umax enter it
+    scale = tol*max(1.0, abs(umax))
+
+    return np.where(active, mu > -scale, force > umax + scale)
@@ -0,0 +1,80 @@
+#
+# Optimal Control of a Vehicle
+# Reference Trajectories from a Schedule of Cornering Equilibria
+# Rapallini Antonio & Bertamè Sebastiano
+# Bologna, 04/01/2024
+#
+
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+import Dynamics as dyn
+import Equilibrium as eqb
+
+
+def reference(segments, model=None, smooth=None):
+
+    # Reference through the cornering equilibria of the list segments = [(V, beta, duration), ...]:
+    # V, beta, psi dot and the inputs are the ones of the equilibrium of each segment, held for
+    # round(duration/dt) samples, while x, y and psi are integrated along the whole reference.
+    # The integration is the one of next_state() with the Euler integrator, written as an exclusive
+    # cumulative sum: the sample tt only depends on the samples before it.
+    #
+    # smooth: None for the step reference (Task 1), or a fraction in (0, 0.5) to replace every step
+    #         with a PCHIP spline starting smooth*duration before the end of a segment and ending
+    #         smooth*duration after the start of the next one (Task 2 uses 1/3). As in Task 2 only
+    #         V, beta, psi dot and the inputs are smoothed, sampled on linspace(0, total duration, TT)
+    #
+    # Returns traj_ref (ns+ni, TT) and the equilibria eq (ns+ni, number of segments), with the
+    # x, y and psi of the start of every segment
+
+    if model is None:
+        model = dyn.model
+
+    ns, ni, dt = model.ns, model.ni, model.dt
+
+    V, beta, duration = np.array(segments, dtype=float).T
+    samples = np.rint(duration/dt).astype(int)
+    TT = np.sum(samples)
+
+    # Equilibria of all the segments at once
+    eq = np.zeros((ns+ni, len(segments)))
+    eq[3] = V
+    eq[4] = beta
+    eq[5:] = eqb.trim_table(model).query(V, beta, refine=True)
+
+    traj_ref = np.zeros((ns+ni, TT))
+    traj_ref[3:] = np.repeat(eq[3:], samples, axis=1)
+
+    # x, y, psi - exclusive cumulative sums of the Euler steps
+    VV, BB, RR = traj_ref[3], traj_ref[4], traj_ref[5]
+
+    traj_ref[2,1:] = np.cumsum(dt*RR[:-1])
+    psi = traj_ref[2]
+    traj_ref[0,1:] = np.cumsum(dt*(VV*np.cos(BB)*np.cos(psi) - VV*np.sin(BB)*np.sin(psi))[:-1])
+    traj_ref[1,1:] = np.cumsum(dt*(VV*np.cos(BB)*np.sin(psi) + VV*np.sin(BB)*np.cos(psi))[:-1])
+
+    starts = np.concatenate(([0], np.cumsum(samples)[:-1]))
+    eq[:3] = traj_ref[:3, starts]
+
+    if smooth is not None:
+        traj_ref[3:] = smoothing(eq[3:], duration, smooth, TT)
+
+    return traj_ref, eq
+
+
+def smoothing(values, duration, smooth, TT):
+
+    # PCHIP through the flat part of every segment: values (n, number of segments) are held from
+    # smooth*duration after the start to smooth*duration before the end of each segment (from the
+    # start of the first one and up to the end of the last one). Returns (n, TT)
+
+    ends = np.cumsum(duration)
+    starts = ends - duration
+
+    knots = np.column_stack((starts + smooth*duration, ends - smooth*duration))
+    knots[0,0] = starts[0]
+    knots[-1,1] = ends[-1]
+
+    cs = PchipInterpolator(knots.ravel(), np.repeat(values, 2, axis=1), axis=1)
+
+    return cs(np.linspace(0, ends[-1], TT))
@@ -0,0 +1,162 @@
+#
+# Optimal Control of a Vehicle
+# Warm-start Cache of the Newton's Method
+# Rapallini Antonio & Bertamè Sebastiano
+# Bologna, 04/01/2024
+#
+
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import Dynamics as dyn
+import Costs as cst
+
+
+max_relative_distance = 0.01     # default largest distance of lookup(), relative to the cost of the constant initial guess
+
+
+class WarmStart:
+
+    # Optimal trajectories of the problems already solved, used as initial guess of Newton().
+    # A problem is identified by its reference (xx_ref, uu_ref), the cost matrices and the model
+    # (kind, parameters and discretization). Only problems with the same cost matrices, model and
+    # horizon are compared: lookup() returns the solution of the closest reference within a distance
+    # (by default a fraction max_relative_distance of the cost of the constant initial guess of main.py),
+    # the solution of the identical problem only if asked for. The distance between two references is
+    # the cost of one with respect to the other.
+    # At most capacity problems are kept, the least recently used one is dropped first. With a path
+    # the cache is loaded from and saved to a .npz file, so that it survives between runs
+
+    def __init__(self, capacity=64, path=None):
+
+        self.capacity = capacity
+        self.path = path
+        self.entries = OrderedDict()    # key -> (context, xx_ref, uu_ref, xx, uu), most recent last
+
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def context(model, TT, QQ, RR, QQf):
+
+        # Hash of everything but the reference: problems are compared only within the same context
+        data = repr((model.kind, model.integrator, model.dt, sorted(model.params.items()), TT)).encode()
+        for MM in (QQ, RR, QQf):
+            data += np.ascontiguousarray(MM, dtype=float).tobytes()
+
+        return hashlib.sha1(data).hexdigest()[:16]
+
+    @staticmethod
+    def key(context, xx_ref, uu_ref):
+
+        data = context.encode()
+        for MM in (xx_ref, uu_ref):
+            data += np.ascontiguousarray(MM, dtype=float).tobytes()
+
+        return hashlib.sha1(data).hexdigest()[:16]
+
+    def lookup(self, xx_ref, uu_ref, model=None, QQ=None, RR=None, QQf=None, max_distance=None, exact=False):
+
+        # Initial guess (xx, uu) for the reference xx_ref (ns, TT), uu_ref (ni, TT), None if no problem
+        # of the same context was solved or if the closest one is farther than max_distance.
+        # max_distance None: max_relative_distance times the cost of the constant initial guess xx_ref[:,0],
+        # uu_ref[:,0]. exact: use the solution of the identical problem if it was solved, otherwise it
+        # is skipped (solving it again from its own solution would stop at the first iteration)
+
+        model, QQ, RR, QQf = defaults(model, QQ, RR, QQf)
+        context = self.context(model, xx_ref.shape[1], QQ, RR, QQf)
+        key = self.key(context, xx_ref, uu_ref)
+
+        if max_distance is None:
+            TT = xx_ref.shape[1]
+            xx_init = np.repeat(xx_ref[:,[0]], TT, axis=1)
+            uu_init = np.repeat(uu_ref[:,[0]], TT, axis=1)
+            max_distance = max_relative_distance*cst.trajcost(xx_init, uu_init, xx_ref, uu_ref, QQ, RR, QQf)[0]
+
+        if exact and key in self.entries:
+            best = key
+        else:
+            best = self.nearest(context, xx_ref, uu_ref, QQ, RR, QQf, max_distance, exclude=key)
+
+        if best is None:
+            return None
+
+        self.entries.move_to_end(best)
+        xx, uu = self.entries[best][3:]
+
+        return xx.copy(), uu.copy()
+
+    def nearest(self, context, xx_ref, uu_ref, QQ, RR, QQf, max_distance, exclude=None):
+
+        # Key of the closest reference of the same context within max_distance (other than the key
+        # exclude), None if there is none
+        best, best_distance = None, max_distance
+        for kk, entry in self.entries.items():
+            if entry[0] != context or kk == exclude:
+                continue
+            distance = cst.trajcost(entry[1], entry[2], xx_ref, uu_ref, QQ, RR, QQf)[0]
+            if distance <= best_distance:
+                best, best_distance = kk, distance
+
+        return best
+
+    def store(self, xx_ref, uu_ref, xx, uu, model=None, QQ=None, RR=None, QQf=None):
+
+        # Save the solution (xx, uu) of the problem with reference (xx_ref, uu_ref)
+
+        model, QQ, RR, QQf = defaults(model, QQ, RR, QQf)
+        context = self.context(model, xx_ref.shape[1], QQ, RR, QQf)
+        key = self.key(context, xx_ref, uu_ref)
+
+        self.entries[key] = (context, np.array(xx_ref, dtype=float), np.array(uu_ref, dtype=float),
+                             np.array(xx, dtype=float), np.array(uu, dtype=float))
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    #######################################
+    # Persistence
+    #######################################
+
+    def save(self, path=None):
+
+        path = self.path if path is None else path
+
+        arrays = {'keys': np.array(list(self.entries.keys())),
+                  'contexts': np.array([entry[0] for entry in self.entries.values()])}
+        for ii, entry in enumerate(self.entries.values()):
+            for name, MM in zip(('xx_ref', 'uu_ref', 'xx', 'uu'), entry[1:]):
+                arrays['{}_{}'.format(name, ii)] = MM
+
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(temp_path, path)     # atomic, a run that stops while saving keeps the previous cache
+
+    def load(self, path=None):
+
+        path = self.path if path is None else path
+
+        with np.load(path) as data:
+            for ii, (key, context) in enumerate(zip(data['keys'], data['contexts'])):
+                entry = [data['{}_{}'.format(name, ii)] for name in ('xx_ref', 'uu_ref', 'xx', 'uu')]
+                self.entries[str(key)] = (str(context), *entry)
+
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+def defaults(model, QQ, RR, QQf):
+
+    # Default model and cost matrices, the ones used by Newton()
+    model = dyn.model if model is None else model
+    QQ = cst.QQt if QQ is None else QQ
+    RR = cst.RRt if RR is None else RR
+    QQf = cst.QQT if QQf is None else QQf
+
+    return model, QQ, RR, QQf
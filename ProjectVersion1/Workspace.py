@@ -0,0 +1,54 @@
+#
+# Optimal Control of a Vehicle
+# Solver Workspace
+# Rapallini Antonio & Bertamè Sebastiano
+# Bologna, 04/01/2024
+#
+
+import numpy as np
+
+
+class Workspace:
+
+    # Arrays written in place by ltv_LQR, by the rollouts of the line search and by the Newton's
+    # and gradient methods, allocated once for a given size (ns, ni, TT) and reused by every call
+    # that receives the workspace, e.g. the repeated solves of a receding-horizon loop.
+    # The arrays returned by a routine that uses a workspace are views of these buffers, they are
+    # overwritten by the next call: copy them if they have to be kept
+    #
+    # batch: number of trajectories rolled out at once (Newton.armijo_batch)
+
+    def __init__(self, ns, ni, TT, batch=8):
+
+        self.ns = ns
+        self.ni = ni
+        self.TT = TT
+        self.batch = batch
+
+        # LQR - gains, feedforward terms, Riccati matrices and optimal trajectory
+        self.KK = np.zeros((ni, ns, TT))
+        self.sigma = np.zeros((ni, TT))
+        self.PP = np.zeros((ns, ns, TT))
+        self.pp = np.zeros((ns, TT))
+        self.xx = np.zeros((ns, TT))
+        self.uu = np.zeros((ni, TT))
+
+        # Rollouts of the line search, batch trajectories stored along the last axis
+        self.xx_temp = np.zeros((ns, TT, batch))
+        self.uu_temp = np.zeros((ni, TT, batch))
+
+    def check(self, ns, ni, TT):
+
+        if (ns, ni, TT) != (self.ns, self.ni, self.TT):
+            raise ValueError('Workspace sized for (ns, ni, TT) = {}, got {}'.format((self.ns, self.ni, self.TT), (ns, ni, TT)))
+
+    def rollout_buffers(self, M):
+
+        # Buffers for M trajectories, None if they do not fit the workspace
+        if M > self.batch:
+            return None, None
+
+        return self.xx_temp[:,:,:M], self.uu_temp[:,:,:M]
+
+    def __repr__(self):
+        return 'Workspace(ns={}, ni={}, TT={}, batch={})'.format(self.ns, self.ni, self.TT, self.batch)
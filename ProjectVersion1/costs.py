@@ -8,7 +8,7 @@
 import numpy as np
 import Dynamics as dyn
 
-# Import the number of states of the choosen dinamics
+# Import the number of states of the choosen dinamics (default model)
 ns = dyn.ns
 ni = dyn.ni
 
@@ -40,7 +40,7 @@ def stagecost(xx, uu, xx_ref, uu_ref):
     
     lxx = QQt
     luu = RRt
-    lux = np.zeros((ni, ns))
+    lux = np.zeros((uu.shape[0], xx.shape[0]))
 
     return ll.squeeze(), lx, lu, lxx, luu, lux
 
@@ -58,4 +58,57 @@ def termcost(xx, xx_ref):
     lTx = QQT @ (xx - xx_ref)
     lTxx = QQT
 
-    return llT.squeeze(), lTx, lTxx
\ No newline at end of file
+    return llT.squeeze(), lTx, lTxx
+
+
+#######################################
+# Trajectory cost function
+#######################################
+
+def trajcost(xx, uu, xx_ref, uu_ref, QQ=None, RR=None, QQf=None):
+
+    # Cost of a whole trajectory in one vectorized call, xx (ns, TT) and uu (ni, TT), with the same
+    # convention used by the Newton's method: stage costs for tt = 0, ..., TT-1 plus terminal cost
+    # at xx[:,-1]. xx and uu can have extra trailing dimensions (e.g. several candidate trajectories),
+    # in that case the cost is returned for each of them.
+    # The cost matrices default to QQt, RRt, QQT; diagonal matrices are applied as elementwise products
+    #
+    # Returns
+    #   JJ              total cost
+    #   lx (ns, TT), lu (ni, TT), lTx (ns,)     gradients of the stage and terminal costs
+    #   lxx, luu, lux, lTxx                     Hessians (constant along the horizon)
+
+    QQ = QQt if QQ is None else QQ
+    RR = RRt if RR is None else RR
+    QQf = QQT if QQf is None else QQf
+
+    extra = (1,)*(xx.ndim - 2)
+    dx = xx - xx_ref.reshape(xx_ref.shape + extra)
+    du = uu - uu_ref.reshape(uu_ref.shape + extra)
+
+    lx = weight(QQ, dx)
+    lu = weight(RR, du)
+    lTx = weight(QQf, dx[:,-1])
+
+    JJ = 0.5*(np.sum(dx*lx, axis=(0, 1)) + np.sum(du*lu, axis=(0, 1)) + np.sum(dx[:,-1]*lTx, axis=0))
+
+    lxx = QQ
+    luu = RR
+    lux = np.zeros((uu.shape[0], xx.shape[0]))
+
+    return JJ, lx, lu, lTx, lxx, luu, lux, QQf
+
+
+def weight(MM, dd):
+
+    # MM @ dd along the first axis of dd, elementwise if MM is diagonal
+    mm = diagonal(MM)
+    if mm is not None:
+        return mm.reshape(mm.shape + (1,)*(dd.ndim - 1)) * dd
+    return np.tensordot(MM, dd, axes=1)
+
+
+def diagonal(MM):
+
+    # Diagonal of MM if the matrix is diagonal, None otherwise
+    return np.diag(MM).copy() if np.count_nonzero(MM - np.diag(np.diag(MM))) == 0 else None
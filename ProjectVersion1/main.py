@@ -10,15 +10,17 @@ import scipy as sp
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from matplotlib.ticker import (AutoMinorLocator, MultipleLocator) 
-from scipy.optimize import fsolve
 from scipy.integrate import solve_ivp
 from scipy.interpolate import PchipInterpolator
-import cvxpy as cp
 import sys
+import os
 import Dynamics as dyn
 import Costs as cst
 import Newton as nwtn
 import Gradient as grad 
+import Mpc
+import Reference as rf
+from WarmStart import WarmStart
 
 # Allow Ctrl-C to work despite plotting
 import signal
@@ -31,6 +33,8 @@ signal.signal(signal.SIGINT, signal.SIG_DFL)
 
 test = False  # Set true for testing the open loop dynamics and the correctness of the derivatives
 max_iters = 35  # Choose the maximum number of iteration for the Newton's method
+exact_newton = True  # Set true to add the second-order terms of the dynamics (exact Newton), false for Gauss-Newton
+warm_start = False  # Set true to start the Newton's method from the solution of a close reference of the previous runs (saved in warmstart.npz)
 # Set to true the task that you want to simulate
 Task1 = True  # Newton's method on a first try reference trajectory
 Task2 = True  # Newton's method with smoothed trajectory
@@ -48,14 +52,19 @@ Task5 = True  # Animation
 # Trajectory parameters
 ############################################################
 
-tf = dyn.tf  # Final time in seconds
+model = dyn.model  # Vehicle model (parameters and discretization), see Dynamics.Model
 
-dt = dyn.dt  # Get discretization step from dynamics
-ns = dyn.ns  # Get the number of states from the dynamics
-ni = dyn.ni  # Get the number of input from the dynamics
+tf = model.tf  # Final time in seconds
 
-TT = dyn.TT  # Number of discrete-time samples
-TT_mid = dyn.TT_mid
+dt = model.dt  # Get discretization step from dynamics
+ns = model.ns  # Get the number of states from the dynamics
+ni = model.ni  # Get the number of input from the dynamics
+
+TT = model.TT  # Number of discrete-time samples
+TT_mid = model.TT_mid
+
+# Solutions of the previous runs, initial guess of the Newton's method
+warm = WarmStart(path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'warmstart.npz')) if warm_start else None
 
 ############################################################
 # TESTS
@@ -80,7 +89,7 @@ if test == True and ns==6:
     num_steps = int(total_time / dt)
 
     for i in range(num_steps-1):
-        traj = dyn.dynamics(traj, uu)[0]
+        traj = model.next_state(traj, uu)
         x_traj.append(traj[0])
         y_traj.append(traj[1])
 
@@ -120,7 +129,7 @@ if test == True and ns==6:
     du = 1e-3       
     
     # Evaluated the derivatives from the dynamics
-    xxp, fx, fu = dyn.dynamics(xx, uu)
+    xxp, fx, fu = model.dynamics(xx, uu)
     
     # Evaluate the A and B matrices
     AA = fx.T
@@ -139,12 +148,12 @@ if test == True and ns==6:
         dltu[i] = du
 
     xdx = xx + dltx
-    xx_plus = dyn.dynamics(xdx, uu)[0]
+    xx_plus = model.next_state(xdx, uu)
     diff_x = xx_plus - xxp
     check_x = diff_x - AA@dltx
 
     udu = uu + dltu
-    xx_plus = dyn.dynamics(xx, udu)[0]    
+    xx_plus = model.next_state(xx, udu)    
     diff_u = xx_plus - xxp     
     check_u = diff_u - BB@dltu
 
@@ -167,65 +176,31 @@ print(purple_bold_title)
 if ns == 6:
     
   # Import of the parameters of the system
-  mm = dyn.mm  # Kg
-  Iz = dyn.Iz  # Kg*m^2
-  aa = dyn.aa  # m           
-  bb = dyn.bb  # m
-  mi = dyn.mi  # nodim
-  gg = dyn.gg  # m/s^2
-
-  eq = np.zeros((ns+ni, 2))
-  xx_eq = np.zeros((ns,2))
-  uu_eq = np.zeros((ni,2))
-
+  mm = model.mm  # Kg
+  Iz = model.Iz  # Kg*m^2
+  aa = model.aa  # m           
+  bb = model.bb  # m
+  mi = model.mi  # nodim
+  gg = model.gg  # m/s^2
 
   ############################################################
   # Evalutaion of two equilibria for the system
   ############################################################
   
   # We have evaluated the cornering equilibria, so setting Betadot = 0, Vdot = 0 and Psidotdot = 0
-  # Then imposing V(x3) and Beta(x4) we evaluate the other states and inputs
-
-  def equations(vars):
-
-    Beta = [vars[1] - (x3*np.sin(x4) + aa*vars[0])/(x3*np.cos(x4)), - (x3*np.sin(x4) - bb*vars[0])/(x3*np.cos(x4))]               # Beta = [Beta_f, Beta_r]
-    Fz = [mm*gg*bb/(aa+bb), mm*gg*aa/(aa+bb)]                                                                                     # Fz = [F_zf, F_zr]
-    Fy = [mi*Fz[0]*Beta[0], mi*Fz[1]*Beta[1]]                                                                                     # Fy = [F_yf, F_yr]
+  # Then imposing V(x3) and Beta(x4) we evaluate the other states and inputs (see Equilibrium.py,
+  # the equilibria are taken from a table computed once and cached on disk)
 
-    return [((Fy[1] * np.sin(x4) + vars[2] * np.cos(x4 - vars[1]) + Fy[0] * np.sin(x4 - vars[1]))/mm), 
-            (Fy[1] * np.cos(x4) + Fy[0] * np.cos(x4 - vars[1]) - vars[2] * np.sin(x4 - vars[1]))/(mm * x3) - vars[0], 
-            ((vars[2] * np.sin(vars[1]) + Fy[0] * np.cos(vars[1])) * aa - Fy[1] * bb)/Iz]
+  # Schedule of the reference: (V, beta, duration) of every equilibrium, switched at TT_mid
+  segments = [(3, 0.0, TT_mid*dt),        # FIRST EQUILIBRIUM
+              (4, 0.1, (TT-TT_mid)*dt)]   # SECOND EQUILIBRIUM
 
-  # Initial guess for the fsolve evaluation
-  initial_guess = [0.1, 0.1, 5]  # [x5(0), u0(0), u1(0)]
-
-  #######################
-  # FIRST EQUILIBRIUM
-  #######################
-
-  # Imposing x3 and x4 we evaluate the other parameters
-  x3 = 3                  
-  x4 = 0.0
-
-  eq[3,0] = np.copy(x3)                           # V
-  eq[4,0] = np.copy(x4)                           # beta
-  eq[5:,0] = fsolve(equations, [0.1, 0.1, 5])     # psi dot, steering angle, force
-  eq[2,0] = eq[5,0]*int(tf/2)                     # psi   
-  eq[0,0] =(eq[3,0]*np.cos(eq[4,0])*np.cos(eq[2,0])-eq[3,0]*np.sin(eq[4,0])*np.sin(eq[2,0]))*int(tf/2)     # x
-  eq[1,0] =(eq[3,0]*np.cos(eq[4,0])*np.sin(eq[2,0])+eq[3,0]*np.sin(eq[4,0])*np.cos(eq[2,0]))*int(tf/2)     # y
-
-  #######################
-  # SECOND EQUILIBRIUM
-  #######################
-  x3 = 4
-  x4 = 0.1
+  ############################################################
+  # Evalutaion of the reference trajectory
+  ############################################################
 
-  eq[3,1] = np.copy(x3)                           # V
-  eq[4,1] = np.copy(x4)                           # beta
-  eq[5:,1] = fsolve(equations, [0.1, 0.1, 5])     # psi dot, steering angle, force
-  eq[2,1] = eq[2,0] + eq[5,1]*int(tf/2)           # psi   
-  eq[0,1] = eq[0,0] + (eq[3,1]*np.cos(eq[4,1])*np.cos(eq[2,1])-eq[3,1]*np.sin(eq[4,1])*np.sin(eq[2,1]))*int(tf/2)     # x
-  eq[1,1] = eq[1,0] + (eq[3,1]*np.cos(eq[4,1])*np.sin(eq[2,1])+eq[3,1]*np.sin(eq[4,1])*np.cos(eq[2,1]))*int(tf/2)     # y
+  # Step reference signal - for all the states, x, y and psi integrated along the whole reference
+  traj_ref, eq = rf.reference(segments, model)
 
   xx_eq = eq[:ns,:]
   uu_eq = eq[ns:,:]
@@ -237,27 +212,6 @@ if ns == 6:
   print(f" uu at Equilibrium 1:\n  {uu_eq[0:, 0]}")
   print(f" xx at Equilibrium 2:\n  {xx_eq[0:, 1]}")
   print(f" uu at Equilibrium 2:\n  {uu_eq[0:, 1]}")
-  
-  
-  ############################################################
-  # Evalutaion of the reference trajectory
-  ############################################################
-
-  traj_ref = np.zeros((ns+ni, TT))
-  traj_ref[3:,0] = eq[3:,0]
-
-  # Step reference signal - for all the states
-
-  for tt in range(1,TT):
-
-    traj = dyn.dynamics(traj_ref[:6,tt-1], traj_ref[6:,tt-1])[0]
-    traj_ref[:3, tt] = traj[:3]     # used to update x, y, psi
-
-    if tt < TT_mid:
-      traj_ref[3:, tt] = eq[3:,0]
-
-    else:  
-      traj_ref[3:, tt] = eq[3:,1]
 
 
   xx_ref = traj_ref[0:6,:]
@@ -327,7 +281,7 @@ if ns == 2:
   uu_ref = np.zeros((ni, TT))
 
   # Step reference
-  KKeq = dyn.KKeq
+  KKeq = model.KKeq
   xx_ref[0, int(TT/2):] = np.ones((1, int(TT/2))) * np.deg2rad(ref_deg_T)
   uu_ref[0, :] = KKeq * np.sin(xx_ref[0, :])
 
@@ -363,21 +317,31 @@ if Task1 == True:
   blue_bold_title = "\033[1;34mNEWTON'S METHOD EVALUATION:\033[0m"
   print(blue_bold_title)
   
-  xx = np.zeros((ns, TT, max_iters+1))   # state seq.
-  uu = np.zeros((ni, TT, max_iters+1))   # input seq.
+  xx = np.zeros((ns, TT))   # state seq. - initial guess, only the final iterate is kept
+  uu = np.zeros((ni, TT))   # input seq.
 
   # initial conditions
   if ns == 6:
     for tt in range(TT):
-      xx[:,tt,0] = np.copy(xx_ref[:,0])
-      uu[:,tt,0] = np.copy(uu_ref[:,0]) 
+      xx[:,tt] = np.copy(xx_ref[:,0])
+      uu[:,tt] = np.copy(uu_ref[:,0]) 
 
   x0 = np.copy(xx_ref[:,0])
+
+  if warm is not None:
+    seed = warm.lookup(xx_ref, uu_ref, model)
+    if seed is not None:
+      xx, uu = seed
+
   # xx, uu, descent, JJ, kk = grad.Gradient(xx, uu, xx_ref, uu_ref, cst.QQt, cst.RRt, cst.QQT, max_iters)
-  xx, uu, descent, JJ, kk = nwtn.Newton(xx, uu, xx_ref, uu_ref, x0, max_iters)
+  xx, uu, descent, JJ, kk = nwtn.Newton(xx, uu, xx_ref, uu_ref, x0, max_iters, exact_hessian=exact_newton, model=model, history='final')
+
+  if warm is not None:
+    warm.store(xx_ref, uu_ref, xx, uu, model)
+    warm.save()
 
-  xx_star = xx[:,:,kk]
-  uu_star = uu[:,:,kk]
+  xx_star = xx
+  uu_star = uu
   uu_star[:,-1] = uu_star[:,-2]        # for plotting purposes
 
   # Plots of descent direction and cost
@@ -564,8 +528,8 @@ if Task2 == True:
   print(blue_bold_title)
   
   # arrays to store data
-  xx = np.zeros((ns, TT, max_iters+1))   # state seq.
-  uu = np.zeros((ni, TT, max_iters+1))   # input seq.
+  xx = np.zeros((ns, TT))   # state seq. - initial guess, only the final iterate is kept
+  uu = np.zeros((ni, TT))   # input seq.
 
   xx_ref = traj_smooth[0:6,:]
   uu_ref = traj_smooth[6:,:]
@@ -573,15 +537,24 @@ if Task2 == True:
   # initial conditions
   if ns == 6:
     for tt in range(TT):
-      xx[:,tt,0] = np.copy(xx_ref[:,0]) 
-      uu[:,tt,0] = np.copy(uu_ref[:,0])
+      xx[:,tt] = np.copy(xx_ref[:,0]) 
+      uu[:,tt] = np.copy(uu_ref[:,0])
 
   x0 = np.copy(xx_ref[:,0])
 
-  xx, uu, descent, JJ, kk = nwtn.Newton(xx, uu, xx_ref, uu_ref, x0, max_iters)
+  if warm is not None:
+    seed = warm.lookup(xx_ref, uu_ref, model)
+    if seed is not None:
+      xx, uu = seed
 
-  xx_star = xx[:,:,kk]
-  uu_star = uu[:,:,kk]
+  xx, uu, descent, JJ, kk = nwtn.Newton(xx, uu, xx_ref, uu_ref, x0, max_iters, exact_hessian=exact_newton, model=model, history='final')
+
+  if warm is not None:
+    warm.store(xx_ref, uu_ref, xx, uu, model)
+    warm.save()
+
+  xx_star = xx
+  uu_star = uu
   uu_star[:,-1] = uu_star[:,-2]        # for plotting purposes
   
 
@@ -672,17 +645,12 @@ print(purple_bold_title)
 
 if Task3 == True & Task2 == True:
 
-  A_opt = np.zeros((ns, ns, TT))
-  B_opt = np.zeros((ns, ni, TT))
+  A_opt, B_opt = model.linearize(xx_star, uu_star)
+
   Qt_reg = np.zeros((ns, ns, TT))
   Rt_reg = np.zeros((ni, ni, TT))
 
   for tt in range (TT):
-    fx, fu = dyn.dynamics(xx_star[:,tt], uu_star[:,tt])[1:]
-
-    A_opt[:,:,tt] = fx.T
-    B_opt[:,:,tt] = fu.T
-
     Qt_reg[:,:,tt] = cst.QQt
     Rt_reg[:,:,tt] = cst.RRt
 
@@ -733,7 +701,7 @@ if Task3 == True & Task2 == True:
 
   for tt in range(TT-1):
     uu_temp[:,tt] = uu_star[:,tt] + KK_reg[:,:,tt]@(xx_temp[:,tt]-xx_star[:,tt])
-    xx_temp[:,tt+1] = dyn.dynamics(xx_temp[:,tt], uu_temp[:,tt])[0]
+    xx_temp[:,tt+1] = model.next_state(xx_temp[:,tt], uu_temp[:,tt])
 
   xx_reg = xx_temp
   uu_reg = uu_temp
@@ -812,36 +780,6 @@ if Task4 == True & Task2 == True:
 
   Tsim = TT
 
-  def linear_mpc(AA, BB, QQ, RR, tl, QQf, xxt, umax, T_pred):
-
-    xxt = xxt.squeeze()
-    
-    xx_mpc = cp.Variable((ns, T_pred))
-    uu_mpc = cp.Variable((ni, T_pred))
-
-    cost = 0
-    constr = []
-    # Tsim-1-T_pred
-    for tt in range(tl, tl + T_pred -1):
-      cost += cp.quad_form(xx_mpc[:,tt-tl] - xx_star[:,tt], QQ) + cp.quad_form(uu_mpc[:,tt-tl] - uu_star[:,tt], RR)
-      constr += [xx_mpc[:,tt+1-tl] == AA[:,:,tt]@xx_mpc[:,tt-tl] + BB[:,:,tt]@uu_mpc[:,tt-tl],  # dynamics constraint
-              # other max/min values contrant
-              uu_mpc[1,tt-tl] <= umax,
-              ]
-
-    # sums problem objectives and concatenates constraints.
-    cost += cp.quad_form(xx_mpc[:,T_pred-1] - xx_star[:,tl+T_pred-1], QQf)
-    constr += [xx_mpc[:,0] == xxt]
-
-    problem = cp.Problem(cp.Minimize(cost), constr)
-    problem.solve()
-
-    if problem.status == "infeasible":
-    # Otherwise, problem.value is inf or -inf, respectively.
-      print("Infeasible problem! CHECK YOUR CONSTRAINTS!!!")
-
-    return uu_mpc[:,0].value, xx_mpc.value, uu_mpc.value
-
   #############################
   # Model Predictive Control
   #############################
@@ -859,6 +797,15 @@ if Task4 == True & Task2 == True:
   #xx_real_mpc[:,0] = np.array((0,0,0,5,-0.3,-0.1)) 
   #xx_real_mpc[:,0] = np.copy(xx_star[:,0]) 
 
+  # Same problem as Mpc.LinearMPC (cvxpy) and Mpc.OsqpMPC (OSQP, warm started), solved on the Riccati
+  # recursion of ltv_LQR (sparse) or condensed in the inputs, whichever is faster for T_pred on the
+  # first windows of this problem. Both start from the active set of the previous step.
+  # In the last T_pred steps the horizon shrinks to the end of the optimal trajectory (mode='extend'
+  # keeps T_pred, holding the last sample of the trajectory)
+  mpc = Mpc.HorizonMPC(ns, ni, T_pred, cst.QQt, cst.RRt, cst.QQT, umax=u1max,
+                       sample=(xx_real_mpc[:,0], A_opt, B_opt, xx_star, uu_star), mode='shrink')
+  print('MPC solver: {}'.format(mpc.method))
+
   for tt in range(Tsim-1):
     # System evolution - real with MPC
 
@@ -874,15 +821,12 @@ if Task4 == True & Task2 == True:
     RRt = 0.1*np.diag([1000.0, 0.0001])                               # costs for uu = [Delta,F]
     QQT = QQt   # Terminal cost matrix
 
-    if tt < Tsim-T_pred:
-      xx_mpc[:,:,tt], uu_mpc[:,:,tt]  = linear_mpc(A_opt, B_opt, cst.QQt, cst.RRt, tt, cst.QQT, xx_t_mpc, umax=u1max, T_pred = T_pred)[1:]
-      
-      uu_real_mpc[:,tt] = uu_mpc[:,0,tt]
-      xx_real_mpc[:,tt+1] = dyn.dynamics(xx_real_mpc[:,tt], uu_real_mpc[:,tt])[0]
+    xx_pred, uu_pred = mpc.solve(xx_t_mpc, A_opt, B_opt, xx_star, uu_star, tt)[1:]
+    T_hor = xx_pred.shape[1]      # shorter than T_pred at the end with mode='shrink'
+    xx_mpc[:,:T_hor,tt], uu_mpc[:,:T_hor,tt] = xx_pred, uu_pred
 
-    else:
-      uu_real_mpc[:,tt] = uu_mpc[:,tt-(Tsim-T_pred),Tsim-T_pred-1]
-      xx_real_mpc[:,tt+1] = dyn.dynamics(xx_mpc[:,tt-(Tsim-T_pred),Tsim-T_pred-1], uu_real_mpc[:,tt])[0]
+    uu_real_mpc[:,tt] = uu_mpc[:,0,tt]
+    xx_real_mpc[:,tt+1] = model.next_state(xx_real_mpc[:,tt], uu_real_mpc[:,tt])
 
   uu_real_mpc[:,-1] = uu_real_mpc[:,-2]        # for plotting purposes
   #######################################
@@ -932,7 +876,7 @@ if Task4 == True & Task2 == True:
   axs[5].plot(time, xx_star[5,:Tsim], '--g', linewidth=2, label='Optimal')
   axs[5].grid()
   axs[5].set_ylabel('$psi dot$')
-  axs[5].set_xlim([-1,Tsim-T_pred])
+  axs[5].set_xlim([-1,Tsim])
 
   #####
   axs[6].plot(time, uu_real_mpc[0,:Tsim],'m', linewidth=2, label='MPC')
@@ -940,7 +884,7 @@ if Task4 == True & Task2 == True:
   axs[6].grid()
   axs[6].set_ylabel('$delta$')
   axs[6].set_xlabel('time')
-  axs[6].set_xlim([-1,Tsim-T_pred])
+  axs[6].set_xlim([-1,Tsim])
 
   #####
   axs[7].plot(time, uu_real_mpc[1,:Tsim],'m', linewidth=2, label='MPC')
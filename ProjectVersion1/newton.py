@@ -8,19 +8,16 @@
 import sys
 import numpy as np
 import scipy as sp
+from scipy.linalg.lapack import dpotrf, dpotrs
 import matplotlib
 import matplotlib.pyplot as plt
 import Dynamics as dyn
 import Costs as cst
+from Workspace import Workspace
 
 #define params
-ns = dyn.ns  # number of states
-ni = dyn.ni  # number of inputs
-dt = dyn.dt  # sample time
-
-TT = dyn.TT  # Final time in seconds
-tf = dyn.tf   # Number of discrete-time samples
-TT_mid = dyn.TT_mid
+# The dimensions and the dynamics are taken from the model passed to Newton() (dyn.model by default),
+# so that several models or horizons can be solved in the same process
 
 term_cond = 1e-6        #terminal condition
 
@@ -30,13 +27,21 @@ beta = 0.7
 armijo_maxiters = 20    # number of Armijo iterations
 stepsize_0 = 1          # initial stepsize
 armijo_plt = False
+armijo_batch = 8        # number of stepsizes of the Armijo ladder rolled out at once (1 = one after the other)
+
+# EXACT NEWTON PARAMETERS
+hessian_reg = 1e-6      # smallest eigenvalue allowed in the stage Hessians
 
 # Import the cost matrices from costs
 Qt = cst.QQt
 Rt = cst.RRt
 QT = cst.QQT
 
-def ltv_LQR(AAin, BBin, QQin, RRin, SSin, QQfin, TT, x0, qqin = None, rrin = None, qqfin = None, ccin = None):
+def ltv_LQR(AAin, BBin, QQin, RRin, SSin, QQfin, TT, x0, qqin = None, rrin = None, qqfin = None, ccin = None, ws = None):
+
+    # ccin: affine term of the dynamics, x_t+1 = A_t x_t + B_t u_t + c_t, (ns, TT) or (ns,), zero if None
+    # ws: Workspace sized (ns, ni, TT), if given the gains, the Riccati matrices and the returned
+    #     trajectory are written into its buffers instead of newly allocated arrays
     
     try:
         # check if matrix is (.. x .. x TT) - 3 dimensional array 
@@ -85,24 +90,48 @@ def ltv_LQR(AAin, BBin, QQin, RRin, SSin, QQfin, TT, x0, qqin = None, rrin = Non
         exit()
 
 
-    if lA < TT:
-        AAin = AAin.repeat(TT, axis=2)
-    if lB < TT:
-        BBin = BBin.repeat(TT, axis=2)
-    if lQ < TT:
-        QQin = QQin.repeat(TT, axis=2)
-    if lR < TT:
-        RRin = RRin.repeat(TT, axis=2)
-    if lS < TT:
-        SSin = SSin.repeat(TT, axis=2)
+    # Time-invariant arguments (last dimension 1) are read at every stage without being repeated,
+    # time-varying ones need at least the TT-1 stages used by the recursion
+    for name, ll in (('A', lA), ('B', lB), ('Q', lQ), ('R', lR), ('S', lS)):
+        if 1 < ll < TT-1:
+            print("Matrix {} has {} stages, expected 1 (time invariant) or at least {}".format(name, ll, TT-1))
+            exit()
 
     # Check for affine terms
-
-
-    KK = np.zeros((ni, ns, TT))
-    sigma = np.zeros((ni, TT))
-    PP = np.zeros((ns, ns, TT))
-    pp = np.zeros((ns, TT))
+    if qqin is None:
+        qqin = np.zeros((ns, 1))
+    if rrin is None:
+        rrin = np.zeros((ni, 1))
+    if qqfin is None:
+        qqfin = np.zeros(ns)
+
+    if ccin is None:
+        ccin = np.zeros((ns, 1))
+
+    qqin = qqin.reshape(ns, -1)
+    rrin = rrin.reshape(ni, -1)
+    ccin = ccin.reshape(ns, -1)
+
+    # Stage index of every argument: tt if time varying, 0 if time invariant
+    def stage(MM):
+        return (lambda tt: tt) if MM.shape[-1] > 1 else (lambda tt: 0)
+
+    iA, iB, iQ, iR, iS = stage(AAin), stage(BBin), stage(QQin), stage(RRin), stage(SSin)
+    iq, ir, ic = stage(qqin), stage(rrin), stage(ccin)
+
+    if ws is None:
+        KK = np.zeros((ni, ns, TT))
+        sigma = np.zeros((ni, TT))
+        PP = np.zeros((ns, ns, TT))
+        pp = np.zeros((ns, TT))
+
+        xx = np.zeros((ns, TT))
+        uu = np.zeros((ni, TT))
+    else:
+        # every entry read below is written first, except the last stage of KK, sigma and uu,
+        # which is never written and stays zero
+        ws.check(ns, ni, TT)
+        KK, sigma, PP, pp, xx, uu = ws.KK, ws.sigma, ws.PP, ws.pp, ws.xx, ws.uu
 
     QQ = QQin
     RR = RRin
@@ -116,218 +145,358 @@ def ltv_LQR(AAin, BBin, QQin, RRin, SSin, QQfin, TT, x0, qqin = None, rrin = Non
 
     AA = AAin
     BB = BBin
-
-    xx = np.zeros((ns, TT))
-    uu = np.zeros((ni, TT))
+    cc = ccin
 
     xx[:,0] = x0
     
     PP[:,:,-1] = QQf
     pp[:,-1] = qqf
     
-    # Solve Riccati equation
+    # Solve Riccati equation and evaluate KK, sigma in a single backward pass
     for tt in reversed(range(TT-1)):
-        QQt = QQ[:,:,tt]
-        qqt = qq[:,tt][:,None]
-        RRt = RR[:,:,tt]
-        rrt = rr[:,tt][:,None]
-        AAt = AA[:,:,tt]
-        BBt = BB[:,:,tt]
-        SSt = SS[:,:,tt]
+        QQt = QQ[:,:,iQ(tt)]
+        qqt = qq[:,iq(tt)]
+        RRt = RR[:,:,iR(tt)]
+        rrt = rr[:,ir(tt)]
+        AAt = AA[:,:,iA(tt)]
+        BBt = BB[:,:,iB(tt)]
+        SSt = SS[:,:,iS(tt)]
         PPtp = PP[:,:,tt+1]
-        pptp = pp[:, tt+1][:,None]
-
-        MMt_inv = np.linalg.inv(RRt + BBt.T @ PPtp @ BBt)
-        mmt = rrt + BBt.T @ pptp
-        
-        PPt = AAt.T @ PPtp @ AAt - (BBt.T@PPtp@AAt + SSt).T @ MMt_inv @ (BBt.T@PPtp@AAt + SSt) + QQt
-        ppt = AAt.T @ pptp - (BBt.T@PPtp@AAt + SSt).T @ MMt_inv @ mmt + qqt
+        pptp = pp[:,tt+1] + PPtp @ cc[:,ic(tt)]     # gradient of the cost-to-go at A x + B u (affine term)
 
-        PP[:,:,tt] = PPt
-        pp[:,tt] = ppt.squeeze()
+        BBtPP = BBt.T @ PPtp                # shared by MMt, NNt
 
-
-    # Evaluate KK
-    
-    for tt in range(TT-1):
-        QQt = QQ[:,:,tt]
-        qqt = qq[:,tt][:,None]
-        RRt = RR[:,:,tt]
-        rrt = rr[:,tt][:,None]
-        AAt = AA[:,:,tt]
-        BBt = BB[:,:,tt]
-        SSt = SS[:,:,tt]
-
-        PPtp = PP[:,:,tt+1]
-        pptp = pp[:,tt+1][:,None]
-
-        # Check positive definiteness
-
-        MMt_inv = np.linalg.inv(RRt + BBt.T @ PPtp @ BBt)
+        MMt = RRt + BBtPP @ BBt             # input Hessian of the stage
+        NNt = BBtPP @ AAt + SSt
         mmt = rrt + BBt.T @ pptp
 
-        # for other purposes we could add a regularization step here...
+        # Check positive definiteness - Cholesky factorization of MMt (LAPACK directly, the matrices
+        # are tiny and the overhead of the higher level wrappers would dominate)
+        MMt_chol, info = dpotrf(MMt, lower=1)
+        if info != 0:
+            raise np.linalg.LinAlgError("ltv_LQR: R + B'PB is not positive definite at stage {} of {}, "
+                                        "the LQR problem is not well posed (check R and the regularization)".format(tt, TT))
 
-        KK[:,:,tt] = -MMt_inv@(BBt.T@PPtp@AAt + SSt)
-        sigma_t = -MMt_inv@mmt
+        # Solve for the gain and the feedforward term at once, MMt [KK sigma] = -[NNt mmt]
+        KKsigma = -dpotrs(MMt_chol, np.column_stack((NNt, mmt)), lower=1)[0]
+        KK[:,:,tt] = KKsigma[:,:-1]
+        sigma[:,tt] = KKsigma[:,-1]
 
-        sigma[:,tt] = sigma_t.squeeze()
+        PPt = AAt.T @ PPtp @ AAt + NNt.T @ KK[:,:,tt] + QQt
+        ppt = AAt.T @ pptp + NNt.T @ sigma[:,tt] + qqt
+
+        PP[:,:,tt] = 0.5*(PPt + PPt.T)      # keep PP symmetric
+        pp[:,tt] = ppt
 
 
     for tt in range(TT - 1):
         
         # Trajectory
         uu[:, tt] = KK[:,:,tt]@xx[:, tt] + sigma[:,tt]
-        xx_p = AA[:,:,tt]@xx[:,tt] + BB[:,:,tt]@uu[:, tt]
+        xx_p = AA[:,:,iA(tt)]@xx[:,tt] + BB[:,:,iB(tt)]@uu[:, tt] + cc[:,ic(tt)]
 
         xx[:,tt+1] = xx_p
         
     return xx, uu, KK, sigma
 
 
-def Newton (xx, uu, xx_ref, uu_ref, x0, max_iters):
+def convexify(QQ, RR, SS, eps):
 
-    # arrays to store data
-    A = np.zeros((ns, ns, TT))
-    B = np.zeros((ns, ni, TT))
-    d1l = np.zeros((ns, TT))
-    d2l = np.zeros((ni, TT))
+    # Project every stage Hessian [[Q, S^T], [S, R]] onto the matrices with eigenvalues >= eps,
+    # so that the LQR subproblem stays well posed when the second-order dynamics terms are added
+    ns = QQ.shape[0]
 
-    cc = np.zeros((ns,TT))
-    xx0 = np.zeros((ns,))
+    HH = np.concatenate((np.concatenate((QQ, SS.transpose(1, 0, 2)), axis=1),
+                         np.concatenate((SS, RR), axis=1)), axis=0).transpose(2, 0, 1)
 
-    Qtilda = np.zeros((ns, ns, TT))
-    Rtilda = np.zeros((ni, ni, TT))
-    Stilda = np.zeros((ni, ns, TT))
+    ww, VV = np.linalg.eigh(HH)
+    HH = (VV * np.maximum(ww, eps)[:, None, :]) @ VV.transpose(0, 2, 1)
+    HH = HH.transpose(1, 2, 0)
 
-    lmbd = np.zeros((ns, TT, max_iters+1))    # lambdas - costate seq.
+    return HH[:ns,:ns], HH[ns:,ns:], HH[ns:,:ns]
 
-    dJ = np.zeros((ni,TT, max_iters+1))       # DJ - gradient of J wrt u
-    J = np.zeros(max_iters+1)                 # collect cost
-    descent = np.zeros(max_iters+1)           # collect descent direction
-    descent_arm = np.zeros(max_iters+1)       # collect descent direction     
 
-    Dx = np.zeros((ns, TT, max_iters+1))
-    Du = np.zeros((ni, TT, max_iters+1))
+def rollout(model, xx, uu, KK, sigma, x0, stepsizes, ws=None):
 
-    ################################################################################################################
+    # Closed-loop update uu + KK (x - xx) + stepsize*sigma simulated from x0 for several stepsizes
+    # at once with the batched dynamics. Returns xx_temp (ns, TT, M) and uu_temp (ni, TT, M),
+    # with M = len(stepsizes), written into the rollout buffers of the workspace ws if they fit
 
-    for kk in range(max_iters):
-        J[kk] = 0
+    stepsizes = np.asarray(stepsizes, dtype=float)
+    ns, TT = xx.shape
+    ni = uu.shape[0]
 
-        # Parameters evaluation
+    xx_temp = uu_temp = None
+    if ws is not None:
+        ws.check(ns, ni, TT)
+        xx_temp, uu_temp = ws.rollout_buffers(len(stepsizes))
 
-        for tt in range(TT):
-            temp_cost= cst.stagecost(xx[:,tt,kk], uu[:,tt,kk], xx_ref[:,tt], uu_ref[:,tt])[0]
-            J[kk] += temp_cost
-            fx, fu = dyn.dynamics(xx[:,tt,kk], uu[:,tt,kk])[1:]
-            A[:,:,tt] = fx.T
-            B[:,:,tt] = fu.T 
+    if xx_temp is None:
+        xx_temp = np.zeros((ns, TT, len(stepsizes)))
+        uu_temp = np.zeros((ni, TT, len(stepsizes)))
 
-        
-        temp_cost = cst.termcost(xx[:,-1,kk], xx_ref[:,-1])[0]
-        J[kk] += temp_cost
+    xx_temp[:,0] = x0[:,None]
 
-        # Descent direction calculation
-        lmbd_temp = cst.termcost(xx[:,TT-1,kk], xx_ref[:,TT-1])[1]
-        lmbd[:,TT-1,kk] = lmbd_temp.squeeze()
-        
+    for tt in range(TT-1):
+        uu_temp[:,tt] = uu[:,tt,None] + KK[:,:,tt]@(xx_temp[:,tt]-xx[:,tt,None]) + sigma[:,tt,None]*stepsizes
+        xx_temp[:,tt+1] = model.next_state(xx_temp[:,tt], uu_temp[:,tt])
 
-        for tt in reversed(range(TT-1)):                        # integration backward in time
+    return xx_temp, uu_temp
 
-            a, b = cst.stagecost(xx[:,tt, kk], uu[:,tt,kk], xx_ref[:,tt], uu_ref[:,tt])[1:3]          
 
-            d1l[:,tt] = a.squeeze()
-            d2l[:,tt] = b.squeeze()
+def armijo(model, xx, uu, KK, sigma, xx_ref, uu_ref, x0, JJ, descent_arm, ws=None):
 
-            lmbd_temp = A[:,:,tt].T@lmbd[:,tt+1,kk][:,None] + a       # costate equation
-            dJ_temp = B[:,:,tt].T@lmbd[:,tt+1,kk][:,None] + b         # gradient of J wrt u 
-            lmbd[:,tt,kk] = lmbd_temp.squeeze()
-            dJ[:,tt,kk] = dJ_temp.squeeze()
+    # Armijo rule on the ladder of stepsizes stepsize_0*beta^ii, ii = 0, ..., armijo_maxiters-1.
+    # The ladder is split in chunks of armijo_batch stepsizes rolled out together, and the largest
+    # stepsize satisfying the Armijo condition is returned, the same one found trying them one at a time.
+    # Returns the stepsize with its trajectory xx_temp (ns, TT), uu_temp (ni, TT) and cost JJ_temp, so
+    # that they can be used as the next iterate, and the tested stepsizes with their costs (for the Armijo plot).
+    # With a workspace ws the trajectory is a view of its rollout buffers
 
+    ladder = stepsize_0*beta**np.arange(armijo_maxiters)
 
-        # Matrices evaluation
-        for tt in range(TT):
-            Qtilda[:,:,tt], Rtilda[:,:,tt], Stilda[:,:,tt] = cst.stagecost(xx[:,tt,kk], uu[:,tt,kk], xx_ref[:,tt], uu_ref[:,tt])[3:]
-        
-        d1lT, QTilda = cst.termcost(xx[:,-1,kk], xx_ref[:,-1])[1:3]
-        Dx[:,:,kk], Du[:,:,kk], KK, sigma = ltv_LQR(A, B, Qtilda, Rtilda, Stilda, QTilda, TT, xx0, d1l, d2l, d1lT.squeeze(), cc)
+    stepsizes = []  # list of stepsizes
+    costs_armijo = []
 
+    for start in range(0, armijo_maxiters, armijo_batch):
 
-        for tt in reversed(range(TT)): 
-            descent[kk] += Du[:,tt,kk].T@Du[:,tt,kk] 
-            descent_arm[kk] += dJ[:,tt,kk].T@Du[:,tt,kk] 
+        steps = ladder[start:start+armijo_batch]
 
-        # Stepsize selection - ARMIJO
-        stepsizes = []  # list of stepsizes
-        costs_armijo = []
+        xx_temp, uu_temp = rollout(model, xx, uu, KK, sigma, x0, steps, ws)
+        JJ_temp = cst.trajcost(xx_temp, uu_temp, xx_ref, uu_ref)[0]
 
-        stepsize = stepsize_0
+        stepsizes += list(steps)                                # save the stepsizes
+        costs_armijo += list(np.minimum(JJ_temp, 100*JJ))       # save the costs associated to the stepsizes
 
-        if 1:           # to change if you want to use costant stepsize (you also need to change stepsize_0 at the beginning)
-            for ii in range(armijo_maxiters):
+        accepted = np.flatnonzero(JJ_temp <= JJ + c*steps*descent_arm)
 
-                # temp solution update
+        if len(accepted) > 0:
+            ii = accepted[0]
+            print('Armijo stepsize = {:.3e}'.format(steps[ii]))
+            return steps[ii], xx_temp[:,:,ii], uu_temp[:,:,ii], JJ_temp[ii], stepsizes, costs_armijo
 
-                xx_temp = np.zeros((ns,TT))
-                uu_temp = np.zeros((ni,TT))
+    # no stepsize accepted: keep shrinking as the serial rule does
+    stepsize = stepsize_0*beta**armijo_maxiters
 
-                xx_temp[:,0] = x0
+    xx_temp, uu_temp = rollout(model, xx, uu, KK, sigma, x0, [stepsize], ws)
+    JJ_temp = cst.trajcost(xx_temp, uu_temp, xx_ref, uu_ref)[0][0]
 
-                for tt in range(TT-1):
-                    uu_temp[:,tt] = uu[:,tt,kk] + KK[:,:,tt]@(xx_temp[:,tt]-xx[:,tt,kk]) + stepsize*sigma[:,tt]
-                    xx_temp[:,tt+1] = dyn.dynamics(xx_temp[:,tt], uu_temp[:,tt])[0]
+    return stepsize, xx_temp[:,:,0], uu_temp[:,:,0], JJ_temp, stepsizes, costs_armijo
 
-                JJ_temp = 0
 
-                for tt in range(TT):
-                    temp_cost = cst.stagecost(xx_temp[:,tt], uu_temp[:,tt], xx_ref[:,tt], uu_ref[:,tt])[0]
-                    JJ_temp += temp_cost
+def evaluate(model, xx, uu, xx_ref, uu_ref, lmbd, dJ, exact_hessian=False):
 
-                temp_cost = cst.termcost(xx_temp[:,-1], xx_ref[:,-1])[0]
-                JJ_temp += temp_cost
+    # Evaluation stage of a Newton iteration on the trajectory xx (ns, TT), uu (ni, TT): cost,
+    # gradients and Hessians of the cost, linearization and costates, computed once per iteration.
+    # The costates and the gradient of J wrt u are written in place into lmbd (ns, TT) and dJ (ni, TT),
+    # the other terms are returned in the order expected by ltv_LQR
+    #
+    # Returns JJ, AA, BB, QQ, RR, SS, QQf, qq, rr, qqf
 
-                stepsizes.append(stepsize)                              # save the stepsize
-                costs_armijo.append(np.min([JJ_temp, 100*J[kk]]))       # save the cost associated to the stepsize
+    TT = xx.shape[1]
 
-                if JJ_temp > J[kk] + c*stepsize*descent_arm[kk]:
-                    # update the stepsize
-                    stepsize = beta*stepsize
+    # The Hessians of the cost are constant, ltv_LQR reads them as time-invariant matrices
+    # without copying them along the horizon
+    JJ, qq, rr, qqf, QQ, RR, SS, QQf = cst.trajcost(xx, uu, xx_ref, uu_ref)
+    AA, BB = model.linearize(xx, uu)
 
-                else:
-                    print('Armijo stepsize = {:.3e}'.format(stepsize))
-                    break
-        
-        # Armijo plot
-        if armijo_plt:
-            steps = np.linspace(0,stepsize_0,int(2e1))
-            costs = np.zeros(len(steps))
+    # Costate equation, integration backward in time. The transposed Jacobians are stored by
+    # stage so that every step reads a contiguous block
+    AAt = np.ascontiguousarray(AA.transpose(2, 1, 0))
+
+    lmbd[:,TT-1] = qqf
+    for tt in reversed(range(TT-1)):
+        lmbd[:,tt] = AAt[tt] @ lmbd[:,tt+1] + qq[:,tt]
+
+    # Gradient of J wrt u, all the stages at once
+    dJ[:,:TT-1] = np.einsum('ijt,it->jt', BB[:,:,:TT-1], lmbd[:,1:]) + rr[:,:TT-1]
+
+    if exact_hessian:
+        # Second-order terms of the dynamics, lambda_{t+1} * d^2 f, stages 0, ..., TT-2
+        f_xx, f_uu, f_xu = model.hessians(xx[:,:-1], uu[:,:-1])
+        lmbd_next = lmbd[:,1:]
+
+        QQ = QQ[:,:,None] + np.einsum('it,ijkt->jkt', lmbd_next, f_xx)
+        RR = RR[:,:,None] + np.einsum('it,ijkt->jkt', lmbd_next, f_uu)
+        SS = SS[:,:,None] + np.einsum('it,ijkt->kjt', lmbd_next, f_xu)
+
+        QQ, RR, SS = convexify(QQ, RR, SS, hessian_reg)
+
+    return JJ, AA, BB, QQ, RR, SS, QQf, qq, rr, qqf
+
+
+class History:
+
+    # Iterates kept by Newton(), chosen with its history argument
+    #   'full'    every iterate in (ns, TT, max_iters+1) and (ni, TT, max_iters+1) arrays, the ones
+    #             passed as initial guess if they have this shape
+    #   'final'   only the last iterate, (ns, TT) and (ni, TT)
+    #   k (int)   the last k iterates, (ns, TT, k) and (ni, TT, k) from the oldest to the newest
+    #   callable  history(kk, xx, uu, JJ) is called with every iterate, e.g. to stream them to a
+    #             MemmapHistory, and only the last iterate is returned as with 'final'
+
+    def __init__(self, policy, xx, uu, max_iters):
+
+        full = isinstance(policy, str) and policy == 'full'
+        final = isinstance(policy, str) and policy == 'final'
+        last = isinstance(policy, (int, np.integer)) and not isinstance(policy, bool)
+
+        if not (full or final or last or callable(policy)):
+            raise ValueError("history must be 'full', 'final', a number of iterates or a callable, got {!r}".format(policy))
+        if last and policy < 1:
+            raise ValueError('history must keep at least one iterate, got {}'.format(policy))
+
+        self.policy = policy
+        self.count = 0
+
+        xx0 = xx[:,:,0] if xx.ndim == 3 else xx
+        uu0 = uu[:,:,0] if uu.ndim == 3 else uu
 
-            for ii in range(len(steps)):
+        self.xx0 = np.array(xx0, dtype=float)
+        self.uu0 = np.array(uu0, dtype=float)
 
-                step = steps[ii]
-                # temp solution update
+        self.xx = self.uu = None
+        if full:
+            if xx.ndim == 3 and xx.shape[2] >= max_iters+1:
+                self.xx, self.uu = xx, uu
+            else:
+                self.xx = np.zeros(self.xx0.shape + (max_iters+1,))
+                self.uu = np.zeros(self.uu0.shape + (max_iters+1,))
+        elif last:
+            self.xx = np.zeros(self.xx0.shape + (policy,))
+            self.uu = np.zeros(self.uu0.shape + (policy,))
 
-                xx_temp = np.zeros((ns,TT))
-                uu_temp = np.zeros((ni,TT))
+    def initial(self):
 
-                xx_temp[:,0] = x0
+        # Copies of the initial guess, updated in place by Newton()
+        return self.xx0.copy(), self.uu0.copy()
 
-                for tt in range(TT-1):
-                    uu_temp[:,tt] = uu[:,tt,kk] + KK[:,:,tt]@(xx_temp[:,tt]-xx[:,tt,kk]) + step*sigma[:,tt]
-                    xx_temp[:,tt+1] = dyn.dynamics(xx_temp[:,tt], uu_temp[:,tt])[0]
+    def record(self, kk, xx, uu, JJ):
 
-                # temp cost calculation
-                JJ_temp = 0
+        self.count = kk + 1
+        self.xx_last, self.uu_last = xx, uu
 
-                for tt in range(TT):
-                    temp_cost = cst.stagecost(xx_temp[:,tt], uu_temp[:,tt], xx_ref[:,tt], uu_ref[:,tt])[0]
-                    JJ_temp += temp_cost
+        if callable(self.policy):
+            self.policy(kk, xx, uu, JJ)
+        elif self.xx is not None:
+            ii = kk % self.xx.shape[2]          # 'full' never wraps around
+            self.xx[:,:,ii] = xx
+            self.uu[:,:,ii] = uu
 
-                temp_cost = cst.termcost(xx_temp[:,-1], xx_ref[:,-1])[0]
-                JJ_temp += temp_cost
+    def result(self):
 
-                costs[ii] = np.min([JJ_temp, 100*J[kk]])
+        if self.xx is None:
+            return self.xx_last.copy(), self.uu_last.copy()
+
+        if isinstance(self.policy, str):
+            return self.xx, self.uu
+
+        # last k iterates from the oldest to the newest
+        kk = self.xx.shape[2]
+        order = np.arange(self.count - min(self.count, kk), self.count) % kk
+
+        return self.xx[:,:,order], self.uu[:,:,order]
+
+
+class MemmapHistory:
+
+    # History callable writing every iterate of Newton() to .npy files on disk, opened as memory
+    # maps: path + '_xx.npy' (max_iters+1, ns, TT), path + '_uu.npy' (max_iters+1, ni, TT) and
+    # path + '_J.npy' (max_iters+1,). Every iterate is a contiguous block of the files; the
+    # iterates that are not reached are left to zero
+
+    def __init__(self, path, ns, ni, TT, max_iters):
+
+        self.xx = np.lib.format.open_memmap(path + '_xx.npy', mode='w+', shape=(max_iters+1, ns, TT))
+        self.uu = np.lib.format.open_memmap(path + '_uu.npy', mode='w+', shape=(max_iters+1, ni, TT))
+        self.JJ = np.lib.format.open_memmap(path + '_J.npy', mode='w+', shape=(max_iters+1,))
+
+    def __call__(self, kk, xx, uu, JJ):
+
+        self.xx[kk] = xx
+        self.uu[kk] = uu
+        self.JJ[kk] = JJ
+
+    def flush(self):
+
+        for mm in (self.xx, self.uu, self.JJ):
+            mm.flush()
+
+
+def Newton (xx, uu, xx_ref, uu_ref, x0, max_iters, exact_hessian=False, model=None, ws=None, history='full'):
+
+    # xx, uu: initial guess (ns, TT), (ni, TT), or (ns, TT, max_iters+1), (ni, TT, max_iters+1)
+    #         arrays with the guess in [:,:,0]
+    # exact_hessian = False: Gauss-Newton, the stage Hessians are the ones of the cost only
+    # exact_hessian = True:  exact Newton, the second derivatives of the dynamics weighted by the
+    #                        costates are added and the result is regularized with convexify()
+    # model: Dynamics.Model used for the rollouts and the linearizations, dyn.model if None.
+    #        The horizon TT is the length of the reference
+    # ws:    Workspace used by the LQR and by the line search, allocated here if None. Pass the same
+    #        one to repeated solves with the same horizon to avoid reallocating it every time
+    # history: iterates returned in xx, uu, see History. Apart from them only the current iterate
+    #          is kept in memory
+
+    if model is None:
+        model = dyn.model
+
+    ns, ni = model.ns, model.ni
+    TT = xx_ref.shape[1]
+
+    if ws is None:
+        ws = Workspace(ns, ni, TT, armijo_batch)
+
+    hist = History(history, xx, uu, max_iters)
+    xx_k, uu_k = hist.initial()               # current iterate
+
+    # arrays to store data
+    cc = np.zeros((ns,TT))
+    xx0 = np.zeros((ns,))
+
+    lmbd = np.zeros((ns, TT))                 # lambdas - costate seq. of the current iterate
+
+    dJ = np.zeros((ni,TT))                    # DJ - gradient of J wrt u
+    J = np.zeros(max_iters+1)                 # collect cost
+    descent = np.zeros(max_iters+1)           # collect descent direction
+    descent_arm = np.zeros(max_iters+1)       # collect descent direction     
+
+    ################################################################################################################
+
+    for kk in range(max_iters):
+        # Parameters evaluation - cost, derivatives, linearization and costates in a single stage
+
+        JJ, A, B, Qtilda, Rtilda, Stilda, QTilda, d1l, d2l, d1lT = evaluate(model, xx_k, uu_k, xx_ref, uu_ref,
+                                                                            lmbd, dJ, exact_hessian)
+
+        if kk == 0:
+            # from the second iteration on the cost comes from the line search (see below)
+            J[kk] = JJ
+            hist.record(kk, xx_k, uu_k, J[kk])
+
+        Dx, Du, KK, sigma = ltv_LQR(A, B, Qtilda, Rtilda, Stilda, QTilda, TT, xx0, d1l, d2l, d1lT, cc, ws)
+
+
+        descent[kk] = np.sum(Du*Du)
+        descent_arm[kk] = np.sum(dJ*Du)
+
+        # Stepsize selection - ARMIJO
+        stepsizes = []  # list of stepsizes
+        costs_armijo = []
+
+        stepsize = stepsize_0
+        xx_temp = None
+
+        if 1:           # to change if you want to use costant stepsize (you also need to change stepsize_0 at the beginning)
+            stepsize, xx_temp, uu_temp, JJ_temp, stepsizes, costs_armijo = armijo(model, xx_k, uu_k, KK, sigma, xx_ref, uu_ref, x0, J[kk], descent_arm[kk], ws)
+        
+        # Armijo plot
+        if armijo_plt:
+            steps = np.linspace(0,stepsize_0,int(2e1))
+
+            # all the stepsizes of the plot are rolled out at once, outside the workspace that
+            # holds the trajectory accepted by the line search
+            xx_plt, uu_plt = rollout(model, xx_k, uu_k, KK, sigma, x0, steps)
+            costs = np.minimum(cst.trajcost(xx_plt, uu_plt, xx_ref, uu_ref)[0], 100*J[kk])
 
             plt.figure(1)
             plt.clf()
@@ -341,20 +510,18 @@ def Newton (xx, uu, xx_ref, uu_ref, x0, max_iters):
             plt.draw()
             plt.show()
 
-        # Update the current solution
+        # Update the current solution, reusing the trajectory and the cost accepted by the line search
 
-        xx_temp = np.zeros((ns,TT))
-        uu_temp = np.zeros((ni,TT))
+        if xx_temp is None:
+            xx_temp, uu_temp = rollout(model, xx_k, uu_k, KK, sigma, x0, [stepsize], ws)
+            JJ_temp = cst.trajcost(xx_temp, uu_temp, xx_ref, uu_ref)[0][0]
+            xx_temp, uu_temp = xx_temp[:,:,0], uu_temp[:,:,0]
 
-        xx_temp[:,0] = x0
+        xx_k[:] = xx_temp
+        uu_k[:] = uu_temp
+        J[kk+1] = JJ_temp
 
-        for tt in range(TT-1):
-            uu_temp[:,tt] = uu[:,tt,kk] + KK[:,:,tt]@(xx_temp[:,tt]-xx[:,tt,kk]) + stepsize*sigma[:,tt]
-            xx_temp[:,tt+1] = dyn.dynamics(xx_temp[:,tt], uu_temp[:,tt])[0]
-
-
-        xx[:,:,kk+1] = xx_temp
-        uu[:,:,kk+1] = uu_temp
+        hist.record(kk+1, xx_k, uu_k, J[kk+1])
 
         # Termination condition
     
@@ -363,6 +530,8 @@ def Newton (xx, uu, xx_ref, uu_ref, x0, max_iters):
         if descent[kk] <= term_cond:
             break
 
+    xx, uu = hist.result()
+
     return xx, uu, descent, J, kk
 
 